@@ -1,18 +1,444 @@
-import sys, math, csv
+import sys, os, math, csv, json, hashlib
 import pandas as pd
 import numpy as np
 import scipy
-from functools import reduce
-from scipy.stats import rankdata
-from scipy import interpolate
+import scipy.sparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 INPUT_PATH = "/mnt/input/"
 OUTPUT_PATH = "/mnt/output/"
+#Version of the layout of the parsed input cache, caches of other versions are parsed again.
+CACHE_VERSION = 2
+#Version of the layout of the reference artifact, references of other versions are rejected.
+REFERENCE_VERSION = 1
+#Memory a value of a row block takes while it is written to CSV: the Python float of tolist, 
+#its formatted text and its share of the joined lines.
+CSV_VALUE_BYTES = 96
+#Memory a value of a row block takes while it is parsed: its text and token in the parser, 
+#the parsed column and the converted row block.
+PARSE_VALUE_BYTES = 64
+#Largest deviation of a result of reduced precision from float64, relative to the largest value of the 
+#result, that is accepted. Beyond it the input is normalized in float64 instead.
+COMPUTE_TOLERANCE = 1e-5
+
+#Linearly interpolates the columns of Sort with missing values onto n equally spaced points.
+#Column j holds nobs[j] sorted observations followed by NaNs. Columns with the same 
+#number of observations share the interpolation grid and are processed together.
+def _interpolate_sorted(Sort, nobs):
+    n = Sort.shape[0]
+    i = np.arange(n)/(n-1)
+    for k in np.unique(nobs[nobs < n]):
+        cols = np.flatnonzero(nobs == k)
+        if k < 2:
+            #Nothing to interpolate between, a single observation is repeated.
+            Sort[:,cols] = Sort[0,cols]
+            continue
+        pos = i*(k-1)
+        lo = np.minimum(np.floor(pos).astype(np.intp), k-2)
+        frac = (pos - lo)[:,np.newaxis]
+        block = Sort[:k,cols]
+        Sort[:,cols] = block[lo] + frac*(block[lo+1] - block[lo])
+
+
+#Ranks the values of every column of arr, ties get the average of their ranks 
+#(like rankdata(method='average')). NaNs are ranked NaN.
+#All buffers are column major, so that the work along axis 0 runs on contiguous memory.
+#The argsort of arr and its sorted values can be passed in, if they are cached.
+def _average_ranks(arr, order=None, values=None):
+    n, m = arr.shape
+    arr = np.asfortranarray(arr)
+    #The argsort as positions in the flat column major buffer, they gather the sorted values 
+    #and later scatter the ranks back. A cached argsort is copied, it is changed in place.
+    order = np.argsort(arr, axis=0) if order is None else np.array(order, dtype=np.intp, order='F')
+    order = np.asfortranarray(order)
+    order += np.arange(m)*n
+    if values is None:
+        values = np.take(arr.ravel(order='F'), order.ravel(order='F')).reshape((n, m), order='F')
+    pos = np.arange(n)[:,np.newaxis]
+
+    #A tie group starts where the sorted value changes and ends before the next start.
+    #NaN != NaN, so every NaN forms its own group at the end of the column.
+    start = np.empty((n, m), dtype=bool, order='F')
+    start[0] = True
+    np.not_equal(values[1:], values[:-1], out=start[1:])
+    first = np.where(start, pos, 0)
+    np.maximum.accumulate(first, axis=0, out=first)
+    last = np.where(np.roll(start, -1, axis=0), pos, n-1)
+    last[-1] = n-1
+    np.minimum.accumulate(last[::-1], axis=0, out=last[::-1])
+
+    avg = np.add(first, last, dtype=np.float64, order='F')
+    avg /= 2
+    avg += 1
+
+    #Scatter the ranks back to the original positions of the values.
+    ranks = np.empty((n, m), order='F')
+    ranks.ravel(order='F')[order.ravel(order='F')] = avg.ravel(order='F')
+    ranks[np.isnan(arr)] = np.nan
+    return ranks
+
+
+#Linear interpolation between a and b, written exactly like numpy's quantile does it, 
+#so that quantiles computed from order statistics are identical to np.quantile.
+def _lerp(a, b, t):
+    diff_b_a = np.subtract(b, a)
+    lerp_interpolation = np.asanyarray(np.add(a, diff_b_a * t))
+    np.subtract(b, diff_b_a * (1 - t), out=lerp_interpolation, where=t >= 0.5, casting='unsafe')
+    return lerp_interpolation
+
+
+#Splits the columns of a count matrix into blocks whose histograms fit into a bounded 
+#buffer and yields the columns of each block together with the per-column histograms.
+#A value v of column j is counted at index j*width + v of the flattened histogram.
+def _count_histograms(counts, max_bins=2**24):
+    n, m = counts.shape
+    width = int(counts.max()) + 1 if counts.size else 1
+    step = max(1, max_bins // width)
+    for j in range(0, m, step):
+        block = counts[:,j:j+step]
+        keys = block + (np.arange(block.shape[1])*width)
+        hist = np.bincount(keys.ravel(), minlength=block.shape[1]*width)
+        yield slice(j, j+step), keys, hist.reshape(block.shape[1], width)
+
+
+#Counting only beats sorting while the histogram of a column is not much longer than the column.
+def _counting_pays_off(counts):
+    return counts.size > 0 and counts.max() < 2*counts.shape[0]
+
+
+#Average ranks of the columns of a matrix of non-negative integer counts, computed 
+#from the value histogram of each column (counting sort) instead of a comparison sort.
+def _count_ranks(counts):
+    ranks = np.empty(counts.shape)
+    for cols, keys, hist in _count_histograms(counts):
+        #Values equal to v occupy the ranks cum[v]-hist[v]+1 ... cum[v].
+        avg = np.cumsum(hist, axis=1, dtype=np.float64)
+        avg -= (hist - 1)/2
+        ranks[:,cols] = avg.ravel()[keys]
+    return ranks
+
+
+#Quantile q (linear method) of every column of a matrix of non-negative integer counts.
+#The two order statistics around the quantile are read from the cumulative histograms.
+def _count_quantile(counts, q):
+    n, m = counts.shape
+    h = q*(n-1)
+    k = int(np.floor(h))
+    a = np.empty(m, dtype=np.intp)
+    b = np.empty(m, dtype=np.intp)
+    for cols, keys, hist in _count_histograms(counts):
+        cum = np.cumsum(hist, axis=1)
+        #The k-th smallest value (0 based) is the number of values v with cum[v] <= k.
+        a[cols] = np.count_nonzero(cum <= k, axis=1)
+        b[cols] = np.count_nonzero(cum <= min(k+1, n-1), axis=1)
+    return _lerp(a, b, np.asanyarray(h - k))
+
+
+#Parses a count matrix with pandas. The pyarrow engine parses with several threads, 
+#an explicit dtype (e.g. int64 for read counts) saves pandas from inferring the types.
+def _read_csv(input_path, sep, sample_genes_in_input, engine=None, dtype=None, **kwargs):
+    if engine == "pyarrow":
+        try:
+            import pyarrow
+        except ImportError:
+            print("WARNING: pyarrow is not installed, the input is parsed with the default engine.", flush=True)
+            engine = None
+    if (sample_genes_in_input):
+        if dtype is not None:
+            header = pd.read_csv(input_path, sep=sep, index_col = 0, nrows=0)
+            dtype = {name: dtype for name in header.columns}
+        return pd.read_csv(input_path, sep=sep, index_col = 0, engine=engine, dtype=dtype, **kwargs)
+    return pd.read_csv(input_path, sep=sep, header=None, engine=engine, dtype=dtype, **kwargs)
+
+
+#Key of the parsed form of an input file: the hash of its content and the options it is parsed with.
+def _cache_key(input_path, sep, sample_genes_in_input, dtype):
+    h = hashlib.sha256()
+    with open(input_path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    h.update(repr((sep, sample_genes_in_input, dtype)).encode())
+    return h.hexdigest()[:16]
+
+
+#The parsed matrix is cached as a hidden file in the cache directory. The input directory holds 
+#the data of the user and is never written to, unless it is explicitly given as the cache directory.
+def _cache_path(cache_dir, input_name, key, extension):
+    os.makedirs(cache_dir, exist_ok=True)
+    return f"{cache_dir}.{input_name}.{key}{extension}"
+
+
+#The sidecar index holds the sample and gene names and the names of both axes (the first header cell). 
+#It is written after the matrix, so a cache without index is incomplete and ignored.
+def _write_cache_index(cache_path, columns, index, integer_counts):
+    with open(f"{cache_path}.json", "w") as f:
+        json.dump({"version": CACHE_VERSION, "columns": np.asarray(columns).tolist(), 
+                   "index": np.asarray(index).tolist(), "integer_counts": bool(integer_counts),
+                   "columns_name": getattr(columns, "name", None), "index_name": getattr(index, "name", None)}, f)
+
+
+#Returns the cached matrix (memory mapped, or sparse), its sample and gene names and 
+#whether it holds integer counts, or None if there is no usable cache.
+def _read_cache(cache_path):
+    try:
+        with open(f"{cache_path}.json") as f:
+            meta = json.load(f)
+        if meta["version"] != CACHE_VERSION:
+            return None
+        if cache_path.endswith(".npz"):
+            data = scipy.sparse.load_npz(cache_path).tocsc()
+        else:
+            data = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return data, pd.Index(meta["columns"], name=meta["columns_name"]), pd.Index(meta["index"], name=meta["index_name"]), \
+        meta["integer_counts"]
+
+
+#Raw read counts (non-negative integers) allow ranks and quantiles to be computed by counting instead of sorting.
+def _is_count_matrix(frame):
+    return all(pd.api.types.is_integer_dtype(t) for t in frame.dtypes) and bool((frame.to_numpy() >= 0).all())
+
+
+#Reads a count matrix block by block into a sparse CSC matrix, 
+#so that the dense matrix is never held in memory as a whole.
+def _read_sparse(input_path, sep, sample_genes_in_input, dtype=None, chunksize=10000):
+    reader = _read_csv(input_path, sep, sample_genes_in_input, dtype=dtype, chunksize=chunksize)
+    blocks = []
+    index = []
+    integer_counts = True
+    for chunk in reader:
+        columns = list(chunk.columns)
+        index.extend(chunk.index)
+        integer_counts = integer_counts and all(pd.api.types.is_integer_dtype(t) for t in chunk.dtypes)
+        blocks.append(scipy.sparse.csr_matrix(chunk.to_numpy()))
+    data = scipy.sparse.vstack(blocks, format='csc')
+    data.eliminate_zeros()
+    integer_counts = integer_counts and bool((data.data >= 0).all())
+    return data, columns, pd.Index(index, name=chunk.index.name), integer_counts
+
+
+#Quantile q (linear method) of every column of a sparse CSC matrix restricted to the rows in keep.
+#Only the stored values are sorted, the implicit zeros are accounted for by their number, 
+#they sit between the negative and the positive values of each column.
+def _sparse_quantile(data, keep, q):
+    n = np.count_nonzero(keep)
+    m = data.shape[1]
+    col = np.repeat(np.arange(m), np.diff(data.indptr))
+    stored = keep[data.indices]
+    values = data.data[stored]
+    col = col[stored]
+    neg = np.bincount(col[values < 0], minlength=m)
+    nnz = np.bincount(col, minlength=m)
+    start = np.cumsum(nnz) - nnz
+    zeros = n - nnz
+    values = values[np.lexsort((values, col))]
+    
+    def order_statistic(r):
+        if values.size == 0:
+            return np.zeros(m, dtype=data.dtype)
+        idx = np.where(r < neg, start + r, start + r - zeros)
+        stat = values[np.clip(idx, 0, values.size - 1)]
+        return np.where((r >= neg) & (r < neg + zeros), 0, stat).astype(data.dtype)
+
+    h = q*(n-1)
+    k = int(np.floor(h))
+    return _lerp(order_statistic(k), order_statistic(min(k+1, n-1)), np.asanyarray(h - k))
+
+
+#Number of sample columns of the input, parsed from its first line.
+def _count_columns(input_path, sep, sample_genes_in_input):
+    return _read_csv(input_path, sep, sample_genes_in_input, nrows=1).shape[1]
+
+
+#Number of rows of the input: its non-empty lines, without the header.
+def _count_rows(input_path, sample_genes_in_input):
+    rows = 0
+    with open(input_path, "rb") as f:
+        for line in f:
+            if not line.isspace():
+                rows += 1
+    return rows - 1 if sample_genes_in_input else rows
+
+
+#Converts a count matrix once into a column major .npy file at npy_path and memory maps it.
+#The rows are counted first, then the text is parsed block by block straight into the file, 
+#so that only a block of rows is held in memory and no second copy of the matrix is written.
+#Counts are stored as int64. If a block that is not counts follows, the rows written so far 
+#are converted to float64 in place, both dtypes have the same size.
+def _read_memmap(input_path, npy_path, sep, sample_genes_in_input, dtype=None, chunksize=10000):
+    n = _count_rows(input_path, sample_genes_in_input)
+    reader = _read_csv(input_path, sep, sample_genes_in_input, dtype=dtype, chunksize=chunksize)
+    out = None
+    index = []
+    integer_counts = True
+    for chunk in reader:
+        i = len(index)
+        if i + len(chunk) > n:
+            raise ValueError(f"the input has more rows than its {n} non-empty lines")
+        #Only integer columns give an integer matrix, like _is_count_matrix checks it column by column.
+        values = chunk.to_numpy()
+        counts = values.dtype.kind in "iu" and bool((values >= 0).all())
+        if out is None:
+            columns = list(chunk.columns)
+            integer_counts = counts
+            out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.int64 if integer_counts else np.float64, 
+                                            shape=(n, len(columns)), fortran_order=True)
+        elif integer_counts and not counts:
+            integer_counts = False
+            out = _counts_to_float(out, npy_path, i, chunksize)
+        index.extend(chunk.index)
+        out[i:i+len(chunk)] = values
+    if len(index) != n:
+        raise ValueError(f"the input has {len(index)} rows but {n} non-empty lines")
+    out.flush()
+    del out
+    return np.load(npy_path, mmap_mode='r'), columns, pd.Index(index, name=chunk.index.name), integer_counts
+
+
+#Converts the first `rows` rows of the int64 .npy memory map `out` to float64 in place, 
+#in blocks of rows, and returns the file memory mapped as float64.
+def _counts_to_float(out, npy_path, rows, chunksize):
+    shape, offset = out.shape, out.offset
+    out.flush()
+    del out
+    floats = np.memmap(npy_path, dtype=np.float64, mode='r+', offset=offset, shape=shape, order='F')
+    counts = np.memmap(npy_path, dtype=np.int64, mode='r', offset=offset, shape=shape, order='F')
+    for i in range(0, rows, chunksize):
+        floats[i:min(i+chunksize, rows)] = np.array(counts[i:min(i+chunksize, rows)], dtype=np.float64)
+    floats.flush()
+    del floats, counts
+    #The header differs only in the dtype, '<i8' and '<f8' have the same length.
+    with open(npy_path, "r+b") as f:
+        header = f.read(offset)
+        f.seek(0)
+        f.write(header.replace(np.dtype(np.int64).descr[0][1].encode(), np.dtype(np.float64).descr[0][1].encode(), 1))
+    return np.lib.format.open_memmap(npy_path, mode='r+')
+
+
+#Maps the values of the columns of arr to the global means by their fractional rank.
+#The global means are given on the equally spaced grid arange(n)/(n-1), so the 
+#fractional rank of each value maps directly to a position on that grid.
+def _map_ranks(arr, nobs, global_means, integer_counts=False, order=None, values=None):
+    n = arr.shape[0]
+    if order is not None:
+        pos = _average_ranks(np.asarray(arr, dtype=np.float64), order, values)
+    elif integer_counts and _counting_pays_off(arr):
+        pos = _count_ranks(np.asarray(arr, dtype=np.intp))
+    else:
+        pos = _average_ranks(np.asarray(arr, dtype=np.float64))
+    pos -= 1
+    pos *= (n-1)/(nobs-1)
+    isna = np.isnan(pos)
+    pos[isna] = 0
+    lo = pos.astype(np.intp)
+    np.minimum(lo, n-2, out=lo)
+    pos -= lo
+
+    result = global_means[lo]
+    result += pos*np.diff(global_means)[lo]
+    result[isna] = np.nan
+    return result
+
+
+#Columns on which a result of reduced precision is compared with its float64 reference, 
+#spread evenly over the matrix.
+def _check_columns(m, count=16):
+    return np.unique(np.linspace(0, m-1, min(m, count)).astype(np.intp))
+
+
+#Largest absolute and relative deviation of a result from its float64 reference, NaNs are left out.
+def _deviation(result, reference):
+    result = np.asarray(result, dtype=np.float64)
+    diff = np.abs(result - reference)
+    diff[np.isnan(diff)] = 0
+    scale = np.abs(reference)
+    rel = np.divide(diff, scale, out=np.zeros_like(diff), where=scale > 0)
+    return {"max_abs": float(diff.max(initial=0)), "max_rel": float(rel.max(initial=0))}
+
+
+#Formats supported by write_results and write_normfac and the extension of their files.
+OUTPUT_FORMATS = {"csv": ".csv", "npy": ".npy", "parquet": ".parquet"}
+
+
+#The output file name with the extension of the output format, the CSV name is kept as it is configured.
+def _output_name(output_name, output_format):
+    if output_format == "csv":
+        return output_name
+    return os.path.splitext(output_name)[0] + OUTPUT_FORMATS[output_format]
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        print("WARNING: pyarrow is not installed, the output is written as CSV.", flush=True)
+        return False
+
+
+#A CSV field as the csv module writes it: quoted if it contains the separator, a quote or a line break.
+def _csv_field(value):
+    value = str(value)
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+#Writes a block of rows of a matrix in the CSV layout of DataFrame.to_csv. Floats are written with repr 
+#(like to_csv) or, with a precision, in %g notation with that many significant digits. NaN is an empty field.
+#Formatting whole lines at once is several times faster than to_csv, which formats value by value.
+def _write_csv_rows(f, block, index=None, float_precision=None):
+    if float_precision is None and block.dtype == np.float32:
+        #tolist would widen float32 to Python floats, numpy formats them with their own shortest repr like to_csv.
+        text = block.astype(str)
+        text[np.isnan(block)] = ""
+        lines = [",".join(row) for row in text.tolist()]
+    else:
+        lines = _format_rows(block, float_precision)
+    if index is not None:
+        lines = [f"{name},{line}" for name, line in zip(index, lines)]
+    if lines:
+        f.write(os.linesep.join(lines) + os.linesep)
+
+
+def _format_rows(block, float_precision=None):
+    if float_precision is None or block.dtype.kind not in "f":
+        fmt = None
+    else:
+        fmt = ",".join([f"%.{int(float_precision)}g"] * block.shape[1])
+    values = block.tolist()
+    nan_rows = np.isnan(block).any(axis=1) if block.dtype.kind == "f" else np.zeros(len(values), dtype=bool)
+    lines = []
+    for row, has_nan in zip(values, nan_rows.tolist()):
+        if has_nan:
+            lines.append(",".join("" if v != v else (repr(v) if fmt is None else f"%.{int(float_precision)}g" % v) for v in row))
+        elif fmt is None:
+            lines.append(",".join(map(repr, row)))
+        else:
+            lines.append(fmt % tuple(row))
+    return lines
 
 class Client:
     input_data = None
     sample_names = None
     gene_names = None
+    #Name of the gene column of the input, the upper quartile result keeps it like the scaled input does.
+    index_name = None
+    result_index_name = None
+    integer_counts = False
+    memory_budget = None
+    workers = 1
+    compute_dtype = np.dtype(np.float64)
+    #float64 reference of some columns and the deviation of the result from it, with a reduced compute_dtype. 
+    #The deviation of the local means bounds the share of this client in the deviation of the global means.
+    check = None
+    deviation = None
+    means_deviation = None
+    compute_tolerance = COMPUTE_TOLERANCE
+    #The arguments of read_input, the input is read again to fall back to float64.
+    read_arguments = None
 
     local_means = None
     global_means = None
@@ -26,23 +452,86 @@ class Client:
     normfac = None
 
     result = None
+    #Converted input of the memory budget mode that is not kept as a cache.
+    scratch_path = None
+
+    #Argsort and sorted values of every column in the combined mode, shared by both methods. 
+    #In the memory budget mode they are not kept, every method sorts the blocks it needs.
+    sort_order = None
+    sort_values = None
+    #The combined mode, the input is kept until the upper quartile result is written.
+    combined = False
 
-    def __init__(self):
-        pass
+    #Values that a checkpoint keeps, the matrix itself is kept by the input cache.
+    checkpoint_names = ("nobs", "local_zeros", "global_means", "global_zeros", "uquartile", "scalingfactor")
 
-    def read_input(self, input_name, sep, sample_names = None, gene_names = None, sample_genes_in_input = False):
-        input_path = f"{INPUT_PATH}{input_name}"
+    #The directories default to the mounts of the FeatureCloud container, 
+    #a local simulation passes a directory pair for every site.
+    def __init__(self, input_path=None, output_path=None):
+        self.input_path = input_path if input_path is not None else INPUT_PATH
+        self.output_path = output_path if output_path is not None else OUTPUT_PATH
+        #Output .npy files the results are written into while they are computed, by normalization method.
+        self.result_files = {}
+
+    def read_input(self, input_name, sep, sample_names = None, gene_names = None, sample_genes_in_input = False, sparse = False, memory_budget = None,
+                   cache = False, engine = None, dtype = None, workers = 1, compute_dtype = None, compute_tolerance = None, 
+                   cache_dir = None):
+        input_path = f"{self.input_path}{input_name}"
+        self.read_arguments = dict(input_name=input_name, sep=sep, sample_names=sample_names, gene_names=gene_names, 
+                                   sample_genes_in_input=sample_genes_in_input, sparse=sparse, memory_budget=memory_budget, 
+                                   cache=cache, engine=engine, dtype=dtype, workers=workers, cache_dir=cache_dir)
+        self.memory_budget = memory_budget
+        self.workers = max(int(workers), 1)
+        self.compute_dtype = np.dtype(compute_dtype if compute_dtype is not None else np.float64)
+        self.compute_tolerance = compute_tolerance if compute_tolerance is not None else COMPUTE_TOLERANCE
         try:
-            if (sample_genes_in_input):
-                self.input_data = pd.read_csv(input_path, sep=sep, index_col = 0)
+            cache_path = None
+            cached = None
+            if (cache):
+                key = _cache_key(input_path, sep, sample_genes_in_input, dtype)
+                cache_path = _cache_path(cache_dir if cache_dir is not None else self.output_path, input_name, key, 
+                                         ".npz" if sparse else ".npy")
+                cached = _read_cache(cache_path)
+            if cached is not None:
+                print(f'Using parsed input from {cache_path}', flush=True)
+                self.input_data, columns, index, self.integer_counts = cached
+                if not sparse and memory_budget is None:
+                    self.input_data = pd.DataFrame(self.input_data, index=index, columns=columns, copy=False)
+            elif (sparse):
+                self.input_data, columns, index, self.integer_counts = _read_sparse(input_path, sep, sample_genes_in_input, dtype)
+                if cache_path is not None:
+                    scipy.sparse.save_npz(cache_path, self.input_data)
+                    _write_cache_index(cache_path, columns, index, self.integer_counts)
+            elif (memory_budget is not None):
+                npy_path = cache_path if cache_path is not None else f"{self.output_path}{input_name}.npy"
+                #Without the cache the converted matrix is only scratch, it is removed after writing.
+                self.scratch_path = npy_path if cache_path is None else None
+                chunksize = self._row_block(_count_columns(input_path, sep, sample_genes_in_input), 10000, PARSE_VALUE_BYTES)
+                self.input_data, columns, index, self.integer_counts = _read_memmap(input_path, npy_path, sep, sample_genes_in_input, 
+                                                                                    dtype, chunksize)
+                if cache_path is not None:
+                    _write_cache_index(cache_path, columns, index, self.integer_counts)
             else:
-                self.input_data = pd.read_csv(input_path, sep=sep, header=None)
+                self.input_data = _read_csv(input_path, sep, sample_genes_in_input, engine, dtype)
+                if cache_path is not None and self.input_data.to_numpy().dtype.kind in "iuf":
+                    np.save(cache_path, self.input_data.to_numpy())
+                    _write_cache_index(cache_path, self.input_data.columns, self.input_data.index, _is_count_matrix(self.input_data))
         except FileNotFoundError:
             print(f'ERROR: File {input_path} could not be found.', flush=True)
             exit()
         except Exception as e:
             print(f'ERROR: File could not be parsed: {e}', flush=True)
             exit()
+        self.input_name = input_name
+        if not isinstance(self.input_data, pd.DataFrame):
+            if(sample_genes_in_input):
+                #The name of the first header cell, like the index of the dense path keeps it
+                self.index_name = getattr(index, "name", None) if gene_names is None else None
+                sample_names = list(columns)
+                gene_names = list(index)
+            self.sample_names = sample_names
+            self.gene_names = gene_names
+            return
         if sample_names is not None:
             self.input_data.columns = sample_names
         if gene_names is not None:        
@@ -50,20 +539,303 @@ class Client:
         if(sample_genes_in_input):
             sample_names = list(self.input_data.columns)
             gene_names = list(self.input_data.index)
+        self.index_name = self.input_data.index.name
         self.sample_names = sample_names
         self.gene_names = gene_names
+        self.integer_counts = _is_count_matrix(self.input_data)
 
-    def write_results(self,output_name,col=False,row=False):
-        output_path = f"{OUTPUT_PATH}{output_name}"
-        #print(self.result.head(5))
-        self.result.to_csv(output_path, header=col, index=row)
+    #The input matrix as a numpy array (or memory map), without copying it.
+    def _matrix(self):
+        if(isinstance(self.input_data, pd.DataFrame)):
+            return self.input_data.to_numpy()
+        return self.input_data
 
-    def write_normfac(self,normfac_file, sample_names=None):
-        path = f"{OUTPUT_PATH}{normfac_file}"
-        if sample_names is not None:
-            pd.Series(self.normfac, index=sample_names).to_csv(path, header=False, index=True)
+    #Splits the m sample columns into blocks, so that the buffers for one block fit into 
+    #the memory budget (in MB) when a column needs `buffers` arrays of n floats to process.
+    #Each worker gets a block of its own and the same share of the budget. 
+    #Without a memory budget the buffers of all blocks in flight together take no more memory 
+    #than the working buffer of the matrix in the compute dtype.
+    def _column_blocks(self, n, m, buffers):
+        step = max(-(-m // self.workers), 1)
+        if self.memory_budget is not None:
+            step = min(step, max(1, int(self.memory_budget * 2**20 // (self.workers * n * 8 * buffers))))
         else:
-            pd.Series(self.normfac).to_csv(path, header=False, index=False)
+            step = min(step, max(1, m * self.compute_dtype.itemsize // (self.workers * 8 * buffers)))
+        for j in range(0, m, step):
+            yield slice(j, min(j+step, m))
+
+    #Calls func for every column block and adds what it returns to the totals (one per returned value), 
+    #in the order of the blocks, so that the sums are the same in every run. 
+    #With several workers the blocks are processed by a pool of threads: NumPy releases the GIL 
+    #in its sorting and arithmetic kernels, and the threads share the matrix without copying it. 
+    #No more blocks than workers are in flight, so at most that many results wait to be added.
+    def _map_blocks(self, n, m, buffers, func, *totals):
+        def add(result):
+            for total, part in zip(totals, result if len(totals) > 1 else (result,)):
+                total += part
+        blocks = self._column_blocks(n, m, buffers)
+        if self.workers == 1:
+            for cols in blocks:
+                add(func(cols))
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for cols in blocks:
+                pending.append(pool.submit(func, cols))
+                if len(pending) == self.workers:
+                    add(pending.popleft().result())
+            while pending:
+                add(pending.popleft().result())
+
+    #Number of rows of m values that are parsed or written at once. In the memory budget mode 
+    #a block, at value_bytes per value, stays within the budget.
+    def _row_block(self, m, chunksize, value_bytes=CSV_VALUE_BYTES):
+        if self.memory_budget is None:
+            return chunksize
+        return max(1, min(chunksize, int(self.memory_budget * 2**20 // (max(m, 1) * value_bytes))))
+
+    #Creates the result matrix of shape (n, m). In the memory budget mode the result 
+    #is a memory mapped file next to the output, which is removed after writing. 
+    #Given a path, the result is memory mapped from that file, which is the output itself.
+    def _result_buffer(self, n, m, dtype=None, name="result", path=None):
+        dtype = dtype if dtype is not None else self.compute_dtype
+        if self.memory_budget is None and path is None:
+            return np.empty((n, m), dtype=dtype, order='F')
+        path = path if path is not None else f"{self.output_path}{self.input_name}.{name}.npy"
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, m), fortran_order=True)
+
+    #With the npy output format, the result of a normalization method is written into its output file 
+    #block by block as the column blocks are finished, so it is not held in memory and saved afterwards. 
+    #The other formats are written by rows, which needs every column of a row first.
+    def stream_results(self, mode, output_name, output_format):
+        if output_format != "npy" or scipy.sparse.issparse(self.input_data) or self.input_data.shape[0] == 1:
+            return
+        self.result_files[mode] = f"{self.output_path}{_output_name(output_name, output_format)}"
+
+    #Releases a buffer of _result_buffer, a memory mapped one is removed from the disk.
+    def _release(self, buffer):
+        if isinstance(buffer, np.memmap) and os.path.exists(buffer.filename):
+            os.remove(buffer.filename)
+
+    #With a reduced compute dtype, keeps a float64 copy of some columns of the input, 
+    #their result is computed in float64 as well to report how much precision is lost.
+    def _keep_check(self, data):
+        if self.compute_dtype == np.float64:
+            return
+        cols = _check_columns(data.shape[1])
+        self.check = (cols, np.array(data[:,cols], dtype=np.float64, order='F'))
+
+    #Compares the check columns of the result with their float64 reference. The deviation of the global 
+    #means adds to the one of the mapping, it is estimated by the deviation of the local means: every site 
+    #keeps its local means within the tolerance, so the global means, their weighted mean, stay within it too. 
+    #Returns False if the result deviates by more than the tolerance.
+    def _report_deviation(self, result):
+        if self.check is None:
+            return True
+        cols, reference = self.check
+        self.check = None
+        self.deviation = _deviation(result[:,cols], reference)
+        if self.means_deviation is not None:
+            self.deviation["means_max_abs"] = self.means_deviation["max_abs"]
+        self.deviation["bound"] = (self.deviation["max_abs"] + self.deviation.get("means_max_abs", 0)) / \
+            max(float(np.nanmax(np.abs(reference), initial=0)), np.finfo(np.float64).tiny)
+        print(f'Deviation of the {self.compute_dtype.name} result from float64 on {len(cols)} samples: '
+              f'max absolute {self.deviation["max_abs"]:.3g}, max relative {self.deviation["max_rel"]:.3g}, '
+              f'of the local means {self.deviation.get("means_max_abs", 0):.3g}, '
+              f'relative to the largest value {self.deviation["bound"]:.3g}', flush=True)
+        return self.deviation["bound"] <= self.compute_tolerance
+
+    #Compares the check columns, sorted and interpolated like for the local means, with their float64 reference. 
+    #A local mean is the sum of such columns, its deviation per sample is at most the largest one of the columns. 
+    #Returns False if it deviates by more than the tolerance.
+    def _check_means(self):
+        if self.check is None:
+            return True
+        cols, reference = self.check
+        Sort = np.sort(np.asarray(self.arr[:,cols], dtype=self.compute_dtype), axis=0)
+        _interpolate_sorted(Sort, self.nobs[cols])
+        Reference = np.sort(reference, axis=0)
+        _interpolate_sorted(Reference, self.nobs[cols])
+        self.means_deviation = _deviation(Sort, Reference)
+        scale = max(float(np.nanmax(np.abs(Reference), initial=0)), np.finfo(np.float64).tiny)
+        return self.means_deviation["max_abs"] / scale <= self.compute_tolerance
+
+    #Continues in float64 when the reduced compute dtype loses more precision than the tolerance allows. 
+    #The working buffer only holds the matrix in the reduced dtype, so the input is read again.
+    def _fall_back_to_float64(self, function):
+        print(f"WARNING in {function}: the {self.compute_dtype.name} computation deviates from float64 by more than "
+              f"{self.compute_tolerance:.3g}, the input is normalized in float64.", flush=True)
+        self.check = None
+        self.means_deviation = None
+        self.read_input(**self.read_arguments, compute_dtype=np.float64, compute_tolerance=self.compute_tolerance)
+
+    #Writes the result matrix in the output format: 
+    #csv - the layout of DataFrame.to_csv, written in blocks of rows, optionally with fewer significant digits.
+    #npy - the binary matrix (or .npz for a sparse result), the names are written to .samples.txt and .genes.txt. 
+    #      A memory mapped result already is such a file and is only moved.
+    #parquet - one column per sample (and one for the genes), written in row groups (needs pyarrow).
+    def write_results(self, output_name, col=False, row=False, output_format="csv", float_precision=None, chunksize=10000):
+        if output_format == "parquet" and not _has_pyarrow():
+            output_format = "csv"
+        output_path = f"{self.output_path}{_output_name(output_name, output_format)}"
+        if isinstance(self.result, pd.DataFrame):
+            columns = self.result.columns
+            index = self.result.index
+            result = self.result.to_numpy()
+        else:
+            result = self.result.tocsr() if scipy.sparse.issparse(self.result) else self.result
+            columns = pd.Index(self.sample_names if self.sample_names is not None else range(result.shape[1]))
+            index = pd.Index(self.gene_names if self.gene_names is not None else range(result.shape[0]), name=self.result_index_name)
+        n = result.shape[0]
+        chunksize = self._row_block(result.shape[1], chunksize)
+
+        if output_format == "npy":
+            stem = os.path.splitext(output_path)[0]
+            if scipy.sparse.issparse(result):
+                scipy.sparse.save_npz(f"{stem}.npz", result)
+            elif isinstance(self.result, np.memmap):
+                self.result.flush()
+                os.replace(self.result.filename, output_path)
+            else:
+                np.save(output_path, result)
+            if col:
+                with open(f"{stem}.samples.txt", "w") as f:
+                    f.write("".join(f"{name}\n" for name in columns))
+            if row:
+                with open(f"{stem}.genes.txt", "w") as f:
+                    f.write("".join(f"{name}\n" for name in index))
+        elif output_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+            for i in range(0, n, chunksize):
+                block = result[i:i+chunksize]
+                if scipy.sparse.issparse(block):
+                    block = block.toarray()
+                block = pd.DataFrame(block, index=index[i:i+chunksize], columns=[str(name) for name in columns])
+                table = pa.Table.from_pandas(block, preserve_index=row)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
+        else:
+            with open(output_path, "w", newline="") as f:
+                if col:
+                    header = [_csv_field(name) for name in columns]
+                    if row:
+                        header.insert(0, _csv_field(index.name) if index.name is not None else "")
+                    f.write(",".join(header) + os.linesep)
+                names = [_csv_field(name) for name in index] if row else None
+                for i in range(0, n, chunksize):
+                    block = result[i:i+chunksize]
+                    if scipy.sparse.issparse(block):
+                        block = block.toarray()
+                    _write_csv_rows(f, np.asarray(block), names[i:i+chunksize] if row else None, float_precision)
+
+        if isinstance(self.result, np.memmap):
+            filename = self.result.filename
+            self.result = None
+            if os.path.exists(filename) and os.path.abspath(filename) != os.path.abspath(output_path):
+                os.remove(filename)
+        #In the combined mode the upper quartile result still needs the input after the quantile result is written.
+        if not self.combined or self.normfac is not None:
+            self._release_input()
+
+    #Removes the converted input of the memory budget mode, unless it is the cache.
+    def _release_input(self):
+        if self.scratch_path is None:
+            return
+        self.input_data = None
+        self.arr = None
+        if os.path.exists(self.scratch_path):
+            os.remove(self.scratch_path)
+        self.scratch_path = None
+
+    def write_normfac(self, normfac_file, sample_names=None, output_format="csv", float_precision=None):
+        if output_format == "parquet" and not _has_pyarrow():
+            output_format = "csv"
+        path = f"{self.output_path}{_output_name(normfac_file, output_format)}"
+        if output_format == "npy":
+            np.save(path, np.asarray(self.normfac, dtype=np.float64))
+            if sample_names is not None:
+                with open(f"{os.path.splitext(path)[0]}.samples.txt", "w") as f:
+                    f.write("".join(f"{name}\n" for name in sample_names))
+        elif output_format == "parquet":
+            pd.DataFrame({"normfactor": self.normfac}, index=sample_names).to_parquet(path, index=sample_names is not None)
+        else:
+            float_format = f"%.{int(float_precision)}g" if float_precision is not None else None
+            if sample_names is not None:
+                pd.Series(self.normfac, index=sample_names).to_csv(path, header=False, index=True, float_format=float_format)
+            else:
+                pd.Series(self.normfac).to_csv(path, header=False, index=False, float_format=float_format)
+
+    #Saves the global values of the normalization as a reference, further samples can be normalized 
+    #against it locally, without a federated round. Call it before write_results, which may release the result.
+    def write_reference(self, reference_file, mode):
+        values = {"version": REFERENCE_VERSION, "mode": mode, "genes": self.result.shape[0]}
+        if mode == "quantile":
+            values["global_means"] = np.asarray(self.global_means, dtype=np.float64)
+        else:
+            values["global_zeros"] = np.asarray(self.global_zeros, dtype=np.intp)
+            values["scalingfactor"] = np.float64(self.scalingfactor)
+        if self.gene_names is not None:
+            values["gene_names"] = np.asarray(self.gene_names, dtype=str)
+        np.savez(f"{self.output_path}{reference_file}", **values)
+
+    #Loads a reference written by write_reference and checks that it fits the input. 
+    #The global means of a quantile reference are interpolated if the number of genes differs, 
+    #the zero rows of an upper quartile reference are only valid for the same genes in the same order.
+    def read_reference(self, reference_file, mode):
+        path = f"{self.input_path}{reference_file}"
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                reference = dict(f)
+        except (OSError, ValueError) as e:
+            print(f'ERROR: the reference {path} could not be read: {e}', flush=True)
+            exit()
+        if int(reference.get("version", -1)) != REFERENCE_VERSION:
+            print(f'ERROR: the reference {path} has version {reference.get("version")}, version {REFERENCE_VERSION} is needed.', flush=True)
+            exit()
+        if str(reference["mode"]) != mode:
+            print(f'ERROR: the reference {path} is for {reference["mode"]} normalization, not {mode}.', flush=True)
+            exit()
+        n = self.input_data.shape[0]
+        genes = int(reference["genes"])
+        if mode == "quantile":
+            if genes != n:
+                print(f'WARNING: the reference has {genes} genes, the input {n}. The reference distribution is interpolated.', flush=True)
+                reference["global_means"] = np.interp(np.arange(n)/(n-1), np.arange(genes)/(genes-1), reference["global_means"])
+            return reference["global_means"]
+        names = reference.get("gene_names")
+        if genes != n or (names is not None and self.gene_names is not None and list(names) != [str(g) for g in self.gene_names]):
+            print(f'ERROR: the genes of the input do not match the {genes} genes of the reference {path}.', flush=True)
+            exit()
+        return reference["global_zeros"], reference["scalingfactor"]
+
+    #The values of the computation so far, for a checkpoint.
+    def checkpoint_values(self):
+        values = {name: np.asarray(getattr(self, name)) for name in self.checkpoint_names if getattr(self, name) is not None}
+        if self.local_means is not None:
+            values["local_means_samples"] = np.asarray(self.local_means[0])
+            values["local_means"] = np.asarray(self.local_means[1])
+        return values
+
+    #Restores the values of a checkpoint after the input has been read again. What the remaining steps 
+    #need besides the values is rebuilt from the input: the working buffer, and in the combined mode 
+    #the sorted columns as long as the upper quartiles have not been computed.
+    def restore_checkpoint(self, values, mode):
+        if not values:
+            return
+        if mode == "both" and "uquartile" not in values:
+            self.qu_compute_local_statistics()
+        elif mode in ("quantile", "both"):
+            self._prepare_working_buffer()
+        for name in self.checkpoint_names:
+            if name in values:
+                setattr(self, name, values[name][()] if values[name].ndim == 0 else values[name])
+        if "local_means" in values:
+            self.local_means = [int(values["local_means_samples"]), values["local_means"]]
 
 #-------------------------------------------------------------------------
 # Quantile Implementation:
@@ -73,19 +845,17 @@ class Client:
     #normalizeBetweenArrays method in bioconductor limma. 
     #Gordon and Smyth, 2005
     def q_compute_local_means(self):
-        if(isinstance(self.input_data, pd.DataFrame)):
-            data = self.input_data.to_numpy()
-        
+        if scipy.sparse.issparse(self.input_data):
+            print("ERROR in Quantile function: the sparse backend is only available for upper quartile normalization.", flush=True)
+            exit()
         n, m = self.input_data.shape
-          
-        self.arr = np.zeros((n,m))
-        for i in range(m):
-            self.arr[:,i] = data[:,i].astype(np.float64)
+        self._prepare_working_buffer()
          
         if m == 1:
             print("ERROR in Quantile function: There must be more than one sample in the data.", flush=True)
             exit()
         if n == 1:
+            self.arr = np.array(self.arr, dtype=np.float64)
             if np.any(np.isnan(self.arr)):
                 self.arr = self.arr[~np.isnan(self.arr)]
                 m = m - np.count_nonzero(np.isnan(self.arr))
@@ -93,30 +863,66 @@ class Client:
             self.local_means = [m, np.sum(self.arr)]
             return
         
-        
-        Sort = np.empty((n,m))
-        Sort[:] = np.nan
-        
-        nobs = np.array(m * [n])
-        i = np.arange(n)/(n-1)
-        
-        for j in range(m):
-            col = np.sort(self.arr[:,j])
-            
-            nobsj = len(col) - np.count_nonzero(np.isnan(col))
-            if nobsj < n:
-                nobs[j] = nobsj
-                col = col[~(np.isnan(col))]
-                f = scipy.interpolate.interp1d((np.arange(nobsj)/(nobsj-1)), col)
-                Sort[:,j] = f(i)
-            else:
-                Sort[:,j] = col
+        self.nobs = np.empty(m, dtype=np.intp)
+        def block_means(cols):
+            #NaNs are sorted to the end of each column, so the first nobs[j] 
+            #entries of column j are its observed values in ascending order.
+            Sort = np.sort(np.asarray(self.arr[:,cols], dtype=self.compute_dtype), axis=0)
+            nobs = n - np.count_nonzero(np.isnan(Sort), axis=0)
+            _interpolate_sorted(Sort, nobs)
+            self.nobs[cols] = nobs
+            return np.sum(Sort, axis=1, dtype=np.float64)
 
-        self.nobs = nobs
+        means = np.zeros(n)
+        self._map_blocks(n, m, 3, block_means, means)
+        self._check_observations("Quantile function")
+        if not self._check_means():
+            self._fall_back_to_float64("Quantile function")
+            self.q_compute_local_means()
+            return
 
-        self.local_means = [m, np.sum(Sort, axis=1)]
+        self.local_means = [m, means]
         #print(f'Local means vector: {self.local_means}', flush=True)
 
+    #Every sample needs two values that are not NaN: its ranks are scaled by nobs-1 and its 
+    #interpolated means would be NaN, which would spread into the global means of every site.
+    def _check_observations(self, function):
+        few = np.flatnonzero(self.nobs < 2)
+        if few.size > 0:
+            names = [str(self.sample_names[j]) if self.sample_names is not None else str(j) for j in few]
+            print(f"ERROR in {function}: the samples {', '.join(names)} have fewer than two values that are not NaN.", flush=True)
+            exit()
+
+    def _prepare_working_buffer(self):
+        data = self._matrix()
+        if self.memory_budget is None:
+            #The working buffer holds the matrix in the compute dtype and later the result. 
+            #It is a view of the input if that already has the dtype and layout, the input is dropped.
+            self._keep_check(data)
+            self.arr = np.asfortranarray(data, dtype=self.compute_dtype)
+            if not self.arr.flags.writeable:
+                self.arr = self.arr.copy(order='F')
+            self.input_data = None
+        else:
+            #The memory mapped input is read block by block and never changed.
+            self.arr = data
+
+    #Normalizes the samples against the global means of a reference, without local means. 
+    #Unlike in a federated round a single sample is fine.
+    def q_apply_global_means(self, global_means):
+        if scipy.sparse.issparse(self.input_data):
+            print("ERROR in Quantile function: the sparse backend is only available for upper quartile normalization.", flush=True)
+            exit()
+        n, m = self.input_data.shape
+        self._prepare_working_buffer()
+        self.nobs = np.empty(m, dtype=np.intp)
+        def block_nobs(cols):
+            self.nobs[cols] = n - np.count_nonzero(np.isnan(self.arr[:,cols]), axis=0)
+        self._map_blocks(n, m, 1, block_nobs)
+        self._check_observations("Quantile function")
+        self.q_set_global_means(global_means)
+        self.q_compute_local_result()
+
     #Calculates the result of the normalization.
     def q_compute_local_result(self):
         n,m = self.arr.shape
@@ -124,18 +930,46 @@ class Client:
         if n == 1:
             self.result = pd.DataFrame(np.array(m * [self.global_means])).T
             return
-        i = np.arange(n)/(n-1)
 
-        for j in range(m):
-            r = rankdata(self.arr[:,j], method='average')
-            f = scipy.interpolate.interp1d(i, self.global_means)
-            if(self.nobs[j] < n):
-                isna = np.isnan(self.arr[:,j])
-                self.arr[~isna,j] = f((r[~isna]-1)/(self.nobs[j]-1))
+        global_means = np.asarray(self.global_means, dtype=np.float64)
+        if self.check is not None:
+            cols, reference = self.check
+            self.check = (cols, _map_ranks(reference, self.nobs[cols], global_means, self.integer_counts))
+        path = self.result_files.get("quantile")
+        if self.memory_budget is None and self.sort_order is None and path is None:
+            #The ranks of a block only depend on its own columns, so its result overwrites it in place.
+            result = self.arr
+        else:
+            #In the combined mode the matrix is still needed for the upper quartile normalization.
+            result = self._result_buffer(n, m, path=path)
+        def block_result(cols):
+            if self.sort_order is not None:
+                result[:,cols] = _map_ranks(self.arr[:,cols], self.nobs[cols], global_means, 
+                                            order=self.sort_order[:,cols], values=self.sort_values[:,cols])
+                return
+            result[:,cols] = _map_ranks(self.arr[:,cols], self.nobs[cols], global_means, self.integer_counts)
+        self._map_blocks(n, m, 8, block_result)
+        if not self._report_deviation(result):
+            #The ranks are computed again from the float64 input, in the combined mode its sorted columns as well.
+            result = None
+            self._fall_back_to_float64("Quantile function")
+            if self.sort_order is not None:
+                self.qu_compute_local_statistics()
             else:
-                self.arr[:,j] = f((r-1)/(n-1))
+                self._prepare_working_buffer()
+            self.q_compute_local_result()
+            return
 
-        self.result = pd.DataFrame(self.arr, index=self.gene_names, columns=self.sample_names)
+        if self.memory_budget is not None or path is not None:
+            self.result = result
+            if self.memory_budget is None and self.sort_order is None:
+                self.arr = None
+            return
+        if self.sort_order is not None:
+            self.result = pd.DataFrame(result, index=self.gene_names, columns=self.sample_names, copy=False)
+            return
+        self.arr = result
+        self.result = pd.DataFrame(self.arr, index=self.gene_names, columns=self.sample_names, copy=False)
 
     #Set the global means vector.
     def q_set_global_means(self, global_means):
@@ -147,11 +981,30 @@ class Client:
     
     #Checks which lines of the client's input_data are completely zero.
     def uq_compute_local_zeros(self):
-        if(self.input_data.isnull().values.any()):
+        if scipy.sparse.issparse(self.input_data):
+            #Explicit zeros were removed when reading, a row is zero if nothing of it is stored.
+            if(np.isnan(self.input_data.data).any()):
+                print("ERROR in Upper Quartile function: the function can't handle NaNs in input data.", flush=True)
+                exit()
+            row_nnz = np.bincount(self.input_data.indices, minlength=self.input_data.shape[0])
+            self.local_zeros = np.flatnonzero(row_nnz == 0)
+            return
+        data = self._matrix()
+        n, m = data.shape
+        #A single reduction over the rows answers both questions: a row sum is NaN 
+        #if the row contains a NaN, and a sum of absolute values is zero only if 
+        #every value of the row is zero.
+        def block_mass(cols):
+            if self.integer_counts:
+                return data[:,cols].sum(axis=1)
+            return np.abs(data[:,cols]).sum(axis=1)
+
+        row_mass = np.zeros(n)
+        self._map_blocks(n, m, 1, block_mass, row_mass)
+        if(np.isnan(row_mass).any()):
             print("ERROR in Upper Quartile function: the function can't handle NaNs in input data.", flush=True)
             exit()
-        all_zero = self.input_data.eq(0).all(axis=1)
-        self.local_zeros = np.where(all_zero)[0]
+        self.local_zeros = np.flatnonzero(row_mass == 0)
         #print(f'Local zeros of this client in lines: {self.local_zeros}', flush=True)
 
     #Calculates for each sample of the client the upper quartile by library size factor (uqfactor).
@@ -159,24 +1012,106 @@ class Client:
     #calcNormFactors method in bioconductor edgeR. 
     #Robinson and Smyth, 2020
     def uq_compute_uquartile(self):
-        indexes_to_keep = set(range(self.input_data.shape[0])) - set(self.global_zeros)
-        data = self.input_data.take(list(indexes_to_keep))
+        if self.sort_values is not None:
+            self.qu_compute_uquartile()
+            return
+        keep = np.ones(self.input_data.shape[0], dtype=bool)
+        keep[np.asarray(self.global_zeros, dtype=np.intp)] = False
         
-        n,m = data.shape
+        n,m = np.count_nonzero(keep), self.input_data.shape[1]
         if n == 1:
             print("WARNING in Upper Quartile function: if there is only one gene in matrix, the upper quartile will set to 1.", flush=True)
             self.uquartile = np.array(m * [1])
             return
 
-        data = pd.DataFrame(np.sort(data,axis=0))
-    
-        self.uquartile = np.quantile(data,0.75,axis=0)
+        if scipy.sparse.issparse(self.input_data):
+            self.uquartile = _sparse_quantile(self.input_data, keep, 0.75)
+            return
+
+        data = self._matrix()
+        self.uquartile = np.empty(m)
+        def block_uquartile(cols):
+            block = data[keep,cols]
+
+            if self.integer_counts and _counting_pays_off(block):
+                self.uquartile[cols] = _count_quantile(block, 0.75)
+                return
+
+            #Only the two order statistics around the 75th percentile are needed, 
+            #partitioning the (already copied) rows in place puts them into position.
+            h = 0.75*(n-1)
+            k = int(np.floor(h))
+            block.partition([k, min(k+1, n-1)], axis=0)
+            self.uquartile[cols] = _lerp(block[k], block[min(k+1, n-1)], np.asanyarray(h - k))
+        self._map_blocks(n, m, 1, block_uquartile)
         #print(f'Local result: {self.uquartile}', flush=True)
 
     #Compute the local result.
     def uq_compute_local_result(self):
         self.normfac = self.uquartile/self.scalingfactor
-        self.result = self.input_data/self.normfac
+        self.result_index_name = self.index_name
+        path = self.result_files.get("upper quartile")
+        if self.input_data is None:
+            #Combined mode, the matrix is still in the working buffer and is scaled in place 
+            #(or into the output file).
+            n, m = self.arr.shape
+            normfac = self.normfac.astype(self.compute_dtype)
+            result = self.arr if path is None else self._result_buffer(n, m, path=path)
+            def block_result(cols):
+                np.divide(self.arr[:,cols], normfac[cols], out=result[:,cols])
+            self._map_blocks(n, m, 1, block_result)
+            if path is not None:
+                self.result = result
+                self.arr = None
+                return
+            index = pd.Index(self.gene_names, name=self.index_name) if self.gene_names is not None else None
+            self.result = pd.DataFrame(self.arr, index=index, columns=self.sample_names, copy=False)
+            self.arr = None
+            return
+        if scipy.sparse.issparse(self.input_data):
+            #Scale the stored values of each column in place, the zeros stay implicit.
+            self.input_data = self.input_data.astype(np.float64, copy=False)
+            self.input_data.data /= np.repeat(self.normfac, np.diff(self.input_data.indptr))
+            self.result = self.input_data
+            return
+        if self.memory_budget is not None:
+            n, m = self.input_data.shape
+            self.result = self._result_buffer(n, m, path=path)
+            def block_result(cols):
+                self.result[:,cols] = self.input_data[:,cols]/self.normfac[cols]
+            self._map_blocks(n, m, 1, block_result)
+            return
+        #The matrix is converted into the compute dtype (without copying it if it already has that dtype) 
+        #and scaled in place, or block by block into the output file. The input is dropped.
+        index, columns = self.input_data.index, self.input_data.columns
+        data = self._matrix()
+        n, m = data.shape
+        self._keep_check(data)
+        if self.check is not None:
+            cols, reference = self.check
+            self.check = (cols, reference/self.normfac[cols])
+        def scale():
+            normfac = self.normfac.astype(self.compute_dtype)
+            if path is not None:
+                result = self._result_buffer(n, m, path=path)
+                def block_result(cols):
+                    np.divide(np.asarray(data[:,cols], dtype=self.compute_dtype), normfac[cols], out=result[:,cols])
+                self._map_blocks(n, m, 1, block_result)
+                return result
+            result = np.asfortranarray(data, dtype=self.compute_dtype)
+            if not result.flags.writeable:
+                result = result.copy(order='F')
+            result /= normfac
+            return result
+        result = scale()
+        if not self._report_deviation(result):
+            print(f"WARNING in Upper Quartile function: the {self.compute_dtype.name} result deviates from float64 by more than "
+                  f"{self.compute_tolerance:.3g}, it is scaled in float64.", flush=True)
+            self.compute_dtype = np.dtype(np.float64)
+            result = None
+            result = scale()
+        self.input_data = None
+        self.result = result if path is not None else pd.DataFrame(result, index=index, columns=columns, copy=False)
 
     #Set the global zeros vector.
     def uq_set_global_zeros(self, global_zeros):
@@ -188,25 +1123,146 @@ class Client:
         self.scalingfactor = global_result
         #print(f'Scaling factor: {self.scalingfactor}', flush=True)
 
+#---------------------------------------------------------------------------
+# Combined Quantile and Upper Quartile Implementation
+
+    #Sorts every column once and computes the local statistics of both methods: the local means 
+    #and the zero lines. The argsort and the sorted values are kept for the ranks of the quantile 
+    #result and for the upper quartiles. They are as large as the matrix each, so in the memory budget 
+    #mode they are not kept and the ranks and upper quartiles sort their blocks again.
+    def qu_compute_local_statistics(self):
+        if scipy.sparse.issparse(self.input_data):
+            print("ERROR in the combined mode: the sparse backend is only available for upper quartile normalization.", flush=True)
+            exit()
+        n, m = self.input_data.shape
+        if m == 1 or n == 1:
+            print("ERROR in the combined mode: There must be more than one sample and gene in the data.", flush=True)
+            exit()
+        self._prepare_working_buffer()
+        self.combined = True
+
+        cache = self.memory_budget is None
+        if cache:
+            self.sort_order = self._result_buffer(n, m, np.intp, "sort_order")
+            self.sort_values = self._result_buffer(n, m, self.compute_dtype, "sort_values")
+        self.nobs = np.empty(m, dtype=np.intp)
+        def block_statistics(cols):
+            block = np.asarray(self.arr[:,cols], dtype=self.compute_dtype)
+            if cache:
+                order = np.argsort(block, axis=0)
+                Sort = np.take_along_axis(block, order, axis=0)
+                self.sort_order[:,cols] = order
+                self.sort_values[:,cols] = Sort
+            else:
+                Sort = np.sort(block, axis=0)
+            nobs = n - np.count_nonzero(np.isnan(Sort), axis=0)
+            self.nobs[cols] = nobs
+            _interpolate_sorted(Sort, nobs)
+            return np.sum(Sort, axis=1, dtype=np.float64), np.abs(block).sum(axis=1)
+
+        means = np.zeros(n)
+        row_mass = np.zeros(n)
+        self._map_blocks(n, m, 5 if cache else 3, block_statistics, means, row_mass)
+        self._check_observations("the combined mode")
+        if not self._check_means():
+            self._fall_back_to_float64("the combined mode")
+            self.qu_compute_local_statistics()
+            return
+        self.local_means = [m, means]
+        self.local_zeros = np.flatnonzero(row_mass == 0)
+        if(np.isnan(row_mass).any()):
+            print("ERROR in Upper Quartile function: the function can't handle NaNs in input data.", flush=True)
+            exit()
+
+    #Upper quartiles from the sorted columns. The global zero lines are zeros in every column, 
+    #dropping them removes as many zeros from the sorted column: the i-th kept value is the 
+    #i-th sorted value if it is negative and the (i+zeros)-th otherwise. 
+    #Without the sorted columns (memory budget mode) they are selected from the input.
+    def qu_compute_uquartile(self):
+        if self.sort_values is None:
+            self.uq_compute_uquartile()
+            return
+        N, m = self.sort_values.shape
+        zeros = len(self.global_zeros)
+        n = N - zeros
+        if n == 1:
+            print("WARNING in Upper Quartile function: if there is only one gene in matrix, the upper quartile will set to 1.", flush=True)
+            self.uquartile = np.array(m * [1])
+        else:
+            h = 0.75*(n-1)
+            k = int(np.floor(h))
+            self.uquartile = np.empty(m)
+            def block_uquartile(cols):
+                values = self.sort_values[:,cols]
+                negative = np.count_nonzero(values < 0, axis=0)
+                columns = np.arange(values.shape[1])
+                a = values[np.where(k < negative, k, k + zeros), columns]
+                b = values[np.where(min(k+1, n-1) < negative, min(k+1, n-1), min(k+1, n-1) + zeros), columns]
+                self.uquartile[cols] = _lerp(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64), np.asanyarray(h - k))
+            self._map_blocks(N, m, 1, block_uquartile)
+        #The cache is not needed anymore.
+        self._release(self.sort_order)
+        self._release(self.sort_values)
+        self.sort_order = None
+        self.sort_values = None
+
+    #Sets the global means and the global zero lines.
+    def qu_set_global_statistics(self, global_statistics):
+        global_means, global_zeros = global_statistics
+        self.q_set_global_means(global_means)
+        self.uq_set_global_zeros(global_zeros)
+
 
 class Coordinator(Client):
+    #Running aggregates, the local parts of the clients are added as they arrive.
+    means_samples = 0
+    means_sum = None
+    zeros_intersection = None
+    log_uquartile_sum = 0
+    uquartile_count = 0
+
+    checkpoint_names = Client.checkpoint_names + ("means_samples", "means_sum", "zeros_intersection", 
+                                                  "log_uquartile_sum", "uquartile_count")
+
+    #Adds the mean values of a client, weighted by its number of samples.
+    def q_aggregate_local_means(self, local_means):
+        self.means_samples += local_means[0]
+        if self.means_sum is None:
+            self.means_sum = np.array(local_means[1], dtype=np.float64)
+        else:
+            self.means_sum += local_means[1]
+
     #Aggregates the mean values of the clients.
-    def q_compute_global_means(self, local_means):
-        np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
-        local_means = np.sum(local_means,axis=0)
-        return local_means[1]/local_means[0]
-        
+    def q_compute_global_means(self):
+        return self.means_sum/self.means_samples
     
+    #Reduces the zero lines to the lines that are present in each client so far.
+    def uq_aggregate_local_zeros(self, local_zeros):
+        if self.zeros_intersection is None:
+            self.zeros_intersection = np.asarray(local_zeros)
+        else:
+            self.zeros_intersection = np.intersect1d(self.zeros_intersection, local_zeros, assume_unique=True)
+
     #Collects the zero lines of the clients and 
     #reduces them to the lines that are present in each client.
-    def uq_compute_global_zeros(self, local_zeros):
-        return reduce(np.intersect1d, local_zeros)
-    
-    #Calculates the global result
-    def uq_compute_global_result(self,local_uquartile):
-        return np.exp(np.mean(np.log(local_uquartile)))
-
-
+    def uq_compute_global_zeros(self):
+        return self.zeros_intersection
 
+    #Adds the logarithms of the upper quartiles of a client.
+    def uq_aggregate_uquartile(self, local_uquartile):
+        local_uquartile = np.asarray(local_uquartile, dtype=np.float64)
+        self.log_uquartile_sum += np.sum(np.log(local_uquartile))
+        self.uquartile_count += local_uquartile.size
+    
+    #Adds the local means and the zero lines of a client in the combined mode.
+    def qu_aggregate_local_statistics(self, local_statistics):
+        local_means, local_zeros = local_statistics
+        self.q_aggregate_local_means(local_means)
+        self.uq_aggregate_local_zeros(local_zeros)
 
+    def qu_compute_global_statistics(self):
+        return [self.q_compute_global_means(), self.uq_compute_global_zeros()]
 
+    #Calculates the global result (the geometric mean of all upper quartiles)
+    def uq_compute_global_result(self):
+        return np.exp(self.log_uquartile_sum/self.uquartile_count)
@@ -1,44 +1,60 @@
+import io
 import json
-import time
 
-from bottle import Bottle, request
+from bottle import Bottle, request, response
 
 from .logic import logic
 
-api_server = Bottle()
-
 
 # CAREFUL: Do NOT perform any computation-related tasks inside these methods, nor inside functions called from them!
 # Otherwise your app does not respond to calls made by the FeatureCloud system quickly enough
 # Use the threaded loop in the app_flow function inside the file logic.py instead
 
 
-@api_server.post("/setup")
-def ctrl_setup():
-    time.sleep(1)
-    print(f"[API] POST /setup", flush=True)
-    payload = request.json
-    logic.handle_setup(payload["id"], payload["master"], payload["clients"])
-    return ""
-
-
-@api_server.get("/status")
-def ctrl_status():
-    print(f"[API] GET /status (available={logic.status_available} finished={logic.status_finished})", flush=True)
-    return json.dumps({
-        "available": logic.status_available,
-        "finished": logic.status_finished,
-    })
-
-
-@api_server.route("/data", method="GET")
-def ctrl_data_out():
-    print(f"[API] GET /data", flush=True)
-    return logic.handle_outgoing()
-
-
-@api_server.route("/data", method="POST")
-def ctrl_data_in():
-    print(f"[API] POST /data", flush=True)
-    logic.handle_incoming(request.body)
-    return ""
+# Creates the controller API of an app instance. The app serves the module level instance,
+# a local simulation creates one API per simulated site.
+def create_api_server(logic):
+    api_server = Bottle()
+
+    @api_server.post("/setup")
+    def ctrl_setup():
+        print(f"[API] POST /setup", flush=True)
+        payload = request.json
+        logic.handle_setup(payload["id"], payload["master"], payload["clients"])
+        return ""
+
+    @api_server.get("/status")
+    def ctrl_status():
+        print(f"[API] GET /status (available={logic.status_available} finished={logic.status_finished})", flush=True)
+        return json.dumps({
+            "available": logic.status_available,
+            "finished": logic.status_finished,
+        })
+
+    @api_server.route("/data", method="GET")
+    def ctrl_data_out():
+        print(f"[API] GET /data", flush=True)
+        payload = logic.handle_outgoing()
+        if payload is None:
+            return ""
+        # The server streams the payload in blocks from a file object, which shares the buffer of the payload
+        response.content_type = "application/octet-stream"
+        response.content_length = len(payload)
+        return io.BytesIO(payload)
+
+    @api_server.route("/data", method="POST")
+    def ctrl_data_in():
+        print(f"[API] POST /data", flush=True)
+        # Bottle spools a large request body (chunked or not) to a temporary file, it is not read into memory
+        logic.handle_incoming(request.body)
+        return ""
+
+    @api_server.get("/metrics")
+    def ctrl_metrics():
+        print(f"[API] GET /metrics", flush=True)
+        return json.dumps(logic.metrics.report())
+
+    return api_server
+
+
+api_server = create_api_server(logic)
@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from app import wire
+
+#Keeps the progress of the app_flow in the output directory, so that a restarted app resumes with the 
+#state after the last completed one instead of starting over. A checkpoint holds:
+#   state.json - the state to resume with, the fingerprint of the run, whether the outgoing data 
+#                was still waiting to be fetched and how many incoming payloads the app_flow has taken,
+#   dataset<k>.<tag>.npz - the values of the k-th dataset (local and global values, running aggregates),
+#   outgoing.<tag>.bin - the outgoing payload, if it was not fetched yet,
+#   incoming.<seq>.bin - every incoming payload, until a completed state has taken it. A payload that 
+#                        arrives shortly before a restart is not lost, the resumed state takes it again.
+#The files of a checkpoint get a new tag, state.json is replaced last, so a crash while saving 
+#leaves the previous checkpoint intact. The matrix itself is kept by the input cache, in the input/ 
+#directory of the checkpoint unless cache_input is configured.
+
+CHECKPOINT_VERSION = 1
+# Directory of the checkpoint that holds the parsed input
+CHECKPOINT_INPUT = "input/"
+
+
+class Checkpoint:
+
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        # Describes the configuration, the input files and the role of this participant, 
+        # a checkpoint of a different run is not resumed
+        self.fingerprint = fingerprint
+        self.meta = None
+        self.lock = threading.Lock()
+
+    def _write_meta(self, meta):
+        path = f"{self.directory}state.json"
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _incoming(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name.split(".")[1]) for name in os.listdir(self.directory) if name.startswith("incoming."))
+
+    # Returns the state to resume with, the values of every dataset, the outgoing payload (or None), 
+    # the incoming payloads that were not taken yet and the counters of the app_flow. 
+    # Returns None if there is no checkpoint of this run
+    def load(self):
+        try:
+            with open(f"{self.directory}state.json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != CHECKPOINT_VERSION or meta.get("fingerprint") != self.fingerprint:
+            print(f'WARNING: the checkpoint in {self.directory} is of a different run and is not resumed.', flush=True)
+            return None
+        tag = meta["tag"]
+        try:
+            values = []
+            for k in range(meta["datasets"]):
+                with np.load(f"{self.directory}dataset{k}.{tag}.npz", allow_pickle=False) as f:
+                    values.append(dict(f))
+            outgoing = None
+            if meta["available"]:
+                with open(f"{self.directory}outgoing.{tag}.bin", "rb") as f:
+                    outgoing = f.read()
+            incoming = []
+            sequence = self._incoming()
+            for seq in sequence:
+                if seq < meta["taken"]:
+                    continue
+                with open(f"{self.directory}incoming.{seq}.bin", "rb") as f:
+                    incoming.append(wire.read_payload(f))
+        except (OSError, ValueError) as e:
+            print(f'WARNING: the checkpoint in {self.directory} could not be read: {e}', flush=True)
+            return None
+        self.meta = meta
+        return {"state": meta["state"], "values": values, "outgoing": outgoing, "incoming": incoming,
+                "received": meta["received"], "taken": meta["taken"], 
+                "arrived": max(sequence[-1] + 1 if sequence else 0, meta["taken"])}
+
+    # Saves the progress after a completed state. outgoing is the payload that has not been fetched yet, 
+    # taken the number of incoming payloads the app_flow has taken so far
+    def save(self, state, values, outgoing=None, received=0, taken=0):
+        with self.lock:
+            tag = self.meta["tag"] + 1 if self.meta is not None else 1
+            os.makedirs(self.directory, exist_ok=True)
+            for k, dataset_values in enumerate(values):
+                np.savez(f"{self.directory}dataset{k}.{tag}.npz", **dataset_values)
+            if outgoing is not None:
+                with open(f"{self.directory}outgoing.{tag}.bin", "wb") as f:
+                    f.write(outgoing)
+            meta = {"version": CHECKPOINT_VERSION, "fingerprint": self.fingerprint, "tag": tag, "state": state,
+                    "datasets": len(values), "available": outgoing is not None, "received": received, "taken": taken}
+            self._write_meta(meta)
+            self.meta = meta
+            # The files of the earlier checkpoints and the payloads taken by the completed states are not needed anymore
+            for name in os.listdir(self.directory):
+                if name.startswith("incoming."):
+                    if int(name.split(".")[1]) < taken:
+                        os.remove(f"{self.directory}{name}")
+                elif name != "state.json" and f".{tag}." not in name and os.path.isfile(f"{self.directory}{name}"):
+                    os.remove(f"{self.directory}{name}")
+
+    # Keeps the seq-th incoming payload until a completed state has taken it
+    def keep_incoming(self, seq, payload):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{self.directory}incoming.{seq}.bin.tmp", "wb") as f:
+                f.write(payload)
+            os.replace(f"{self.directory}incoming.{seq}.bin.tmp", f"{self.directory}incoming.{seq}.bin")
+
+    # Records that the outgoing data has been fetched, a resumed app must not offer it a second time
+    def fetched(self):
+        with self.lock:
+            if self.meta is None or not self.meta["available"]:
+                return
+            self.meta["available"] = False
+            self._write_meta(self.meta)
+
+    # Removes the checkpoint once the run is complete
+    def remove(self):
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.meta = None
@@ -1,19 +1,25 @@
-import jsonpickle
+import os
+import hashlib
+import json
 import pandas as pd
 import threading
+import cProfile
 import time
 import yaml
 import numpy as np
 
-from app.algo import Coordinator, Client
-from distutils import dir_util
+from app.algo import Coordinator, Client, OUTPUT_FORMATS
+from app import wire
+from app.checkpoint import Checkpoint, CHECKPOINT_INPUT
+from app.metrics import Metrics
+from app.staging import Staging
 
 APP_NAME = 'uq_q_normalization'
 
 
 class AppLogic:
 
-    def __init__(self):
+    def __init__(self, input_dir="/mnt/input/", output_dir="/mnt/output/"):
         # === Status of this app instance ===
         # Indicates whether there is data to share, if True make sure self.data_out is available
         self.status_available = False
@@ -32,16 +38,27 @@ class AppLogic:
 
         # === Internals ===
         self.thread = None
+        # Signaled whenever data arrives or the outgoing data has been fetched, the app_flow waits on it
+        self.condition = threading.Condition()
         self.iteration = 0
+        # Number of participants whose part the coordinator has aggregated in the current round
+        self.received = 0
+        # Number of payloads that have arrived and that the app_flow has taken, over the whole run
+        self.arrived = 0
+        self.taken = 0
         self.progress = 'not started yet'
+        # Time, memory and payload sizes of the states and kernels, served at /api/metrics
+        self.metrics = Metrics()
 
         # === Custom ===
-        self.INPUT_DIR = "/mnt/input/"
-        self.OUTPUT_DIR = "/mnt/output/"
+        self.INPUT_DIR = input_dir
+        self.OUTPUT_DIR = output_dir
 
-        self.client = None
+        # The Client (or Coordinator) of every dataset, several inputs are normalized in one session
+        self.datasets = []
         self.mode = None
         self.input_name = None
+        self.input_names = []
         self.sample_names = None
         self.gene_names = None
         self.sep = None
@@ -51,6 +68,26 @@ class AppLogic:
         self.samples = None
         self.genes = None
         self.colsrows = False
+        self.compress_payloads = False
+        self.sparse = False
+        self.memory_budget = None
+        self.cache_input = False
+        self.cache_dir = None
+        self.csv_engine = None
+        self.input_dtype = None
+        self.workers = 1
+        self.profile = False
+        self.output_format = "csv"
+        self.float_precision = None
+        self.copy_input = True
+        self.compute_dtype = None
+        self.compute_tolerance = None
+        self.save_reference = False
+        self.apply_reference = None
+        self.staging = None
+        # Progress of the run in the output directory, a restarted app resumes from it
+        self.checkpoint = None
+        self.resumed = None
 
     # This method is called once upon startup and contains information about the execution context of this instance
     def handle_setup(self, client_id, coordinator, clients):
@@ -59,39 +96,240 @@ class AppLogic:
         self.clients = clients
         print(f'Received setup: {self.id} {self.coordinator} {self.clients}', flush=True)
 
-        self.read_config()
+        self.metrics.call(self.read_config)
 
-        self.thread = threading.Thread(target=self.app_flow)
+        self.thread = threading.Thread(target=self.run_flow)
         self.thread.start()
         
 
     def handle_incoming(self, data):
-        # This method is called when new data arrives
+        # This method is called when new data arrives. A large payload is spooled to disk and memory mapped
         print("Process incoming data....", flush=True)
-        self.data_incoming.append(data.read())
+        payload = wire.read_payload(data)
+        with self.condition:
+            if self.checkpoint is not None:
+                self.checkpoint.keep_incoming(self.arrived, payload)
+            self.arrived += 1
+            self.data_incoming.append(payload)
+            self.condition.notify_all()
 
     def handle_outgoing(self):
         print("Process outgoing data...", flush=True)
         # This method is called when data is requested
-        self.status_available = False
+        with self.condition:
+            self.status_available = False
+            if self.checkpoint is not None:
+                self.checkpoint.fetched()
+            self.condition.notify_all()
         return self.data_outgoing
 
+    # Blocks the app_flow until the predicate is true, it is rechecked whenever data arrives or is fetched
+    def wait_for(self, predicate):
+        with self.condition:
+            self.condition.wait_for(predicate)
+
+    # Takes all data that has arrived so far, blocks until there is some
+    def take_incoming(self):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.data_incoming) > 0)
+            data, self.data_incoming = self.data_incoming, []
+            self.taken += len(data)
+        return data
+
+    # Decodes the data of the clients as it arrives and passes it to the running aggregation 
+    # of every dataset, until all clients have sent their part
+    def aggregate_incoming(self, kernel):
+        while self.received < len(self.clients):
+            for client_data in self.take_incoming():
+                self.call_all(kernel, self.decode_datasets(client_data))
+                self.received += 1
+
+    # Calls a kernel of algo.py for every dataset, the k-th dataset gets the k-th item of each argument.
+    # Returns the list of the results
+    def call_all(self, kernel, *args):
+        return [self.metrics.call(getattr(dataset, kernel), *(arg[k] for arg in args))
+                for k, dataset in enumerate(self.datasets)]
+
+    # Decodes a payload with one part per dataset, all participants have to normalize the same number of datasets
+    def decode_datasets(self, payload):
+        parts = self.decode(payload)
+        if len(parts) != len(self.datasets):
+            print(f"ERROR: received data of {len(parts)} datasets, but {len(self.datasets)} are configured. "
+                  "All participants need the same number of input files.", flush=True)
+            exit()
+        return parts
+
+    # Serializes the data that is sent to the other instances into the binary wire format
+    def encode(self, data):
+        start = time.perf_counter()
+        payload = self.metrics.call(wire.encode, data, self.compress_payloads)
+        self.metrics.add_bytes("bytes_sent", len(payload))
+        print(f'[WIRE] Encoded {len(payload)} bytes in {(time.perf_counter() - start) * 1000:.2f} ms', flush=True)
+        return payload
+
+    def decode(self, payload):
+        start = time.perf_counter()
+        data = self.metrics.call(wire.decode, payload)
+        self.metrics.add_bytes("bytes_received", len(payload))
+        print(f'[WIRE] Decoded {len(payload)} bytes in {(time.perf_counter() - start) * 1000:.2f} ms', flush=True)
+        return data
+
     def read_config(self):
-        dir_util.copy_tree("/mnt/input/", "/mnt/output/")
-        with open("/mnt/input/config.yml") as f:
+        with open(f"{self.INPUT_DIR}config.yml") as f:
             config = yaml.load(f, Loader=yaml.FullLoader)[APP_NAME]
 
             self.mode = config.get("normalization")
 
             self.input_name = config.get("input_filename", "data.csv")  
             self.colsrows = config.get("sample_genes_in_input", False)
+            self.sparse = config.get("sparse", False)
+            self.memory_budget = config.get("memory_budget", None)
+            self.cache_input = config.get("cache_input", False)
+            self.cache_dir = config.get("cache_dir", None)
+            self.csv_engine = config.get("csv_engine", None)
+            self.input_dtype = config.get("input_dtype", None)
+            self.workers = config.get("workers", 1)
+            self.compute_dtype = config.get("compute_dtype", None)
+            self.compute_tolerance = config.get("compute_tolerance", None)
+            self.save_reference = config.get("save_reference", False)
+            self.apply_reference = config.get("apply_reference", None)
 
             self.output_normfac = config.get("normfactors", False)
             self.output_name = config.get("output_filename", "result.csv")
+            self.output_format = config.get("output_format", "csv")
+            self.float_precision = config.get("float_precision", None)
             self.sample_names = config.get("sample_names", None)
             self.gene_names = config.get("gene_names", None)
 
             self.sep = config.get("seperator", ",")
+            self.compress_payloads = config.get("compress_payloads", False)
+            self.profile = config.get("profile", False)
+            self.copy_input = config.get("copy_input", True)
+            checkpoint = config.get("checkpoint", False)
+
+        # A list of inputs is normalized in one session, every dataset gets its own output files
+        self.input_names = self.input_name if isinstance(self.input_name, list) else [self.input_name]
+
+        # Staged from the app_flow thread, so that the /setup request returns right away
+        self.staging = Staging(self.INPUT_DIR, self.OUTPUT_DIR, self.output_files(), self.copy_input)
+        if checkpoint:
+            # The parsed input cache is the checkpoint of the matrix. Unless it is configured, 
+            # it is kept in the checkpoint and removed with it
+            self.checkpoint = Checkpoint(f"{self.OUTPUT_DIR}.checkpoint/", self.fingerprint())
+            if not self.cache_input:
+                self.cache_dir = f"{self.checkpoint.directory}{CHECKPOINT_INPUT}"
+            self.cache_input = True
+            # Loaded before any data arrives, the payloads kept in the checkpoint keep their numbers
+            if self.apply_reference is None:
+                self.resumed = self.checkpoint.load()
+            if self.resumed is not None:
+                self.arrived = self.resumed["arrived"]
+
+    # Identifies the run a checkpoint belongs to: the config, the input files and the role of this participant
+    def fingerprint(self):
+        h = hashlib.sha256()
+        with open(f"{self.INPUT_DIR}config.yml", "rb") as f:
+            h.update(f.read())
+        inputs = []
+        for name in self.input_names:
+            try:
+                stat = os.stat(f"{self.INPUT_DIR}{name}")
+                inputs.append([name, stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                inputs.append([name, None, None])
+        h.update(json.dumps([inputs, self.id, self.coordinator, self.clients]).encode())
+        return h.hexdigest()[:16]
+
+    # Saves the progress after a completed state, a restarted app resumes with the given state. 
+    # Outgoing data that has not been fetched yet is kept and offered again
+    def save_checkpoint(self, state, datasets=True):
+        if self.checkpoint is None:
+            return
+        values = [dataset.checkpoint_values() for dataset in self.datasets] if datasets else []
+        with self.condition:
+            outgoing = self.data_outgoing if self.status_available else None
+            self.metrics.call(self.checkpoint.save, state, values, outgoing, self.received, self.taken)
+
+    # Restores the progress of a checkpoint after the input has been read, returns the state to resume with. 
+    # The payloads that arrived after the last completed state are taken again
+    def resume(self, checkpoint):
+        state, values = checkpoint["state"], checkpoint["values"]
+        print(f'Resuming from the checkpoint with state {state}', flush=True)
+        self.metrics.info["resumed_with_state"] = state
+        for k, dataset in enumerate(self.datasets):
+            self.metrics.call(dataset.restore_checkpoint, values[k] if k < len(values) else {}, self.mode)
+        self.received = checkpoint["received"]
+        with self.condition:
+            self.data_outgoing = checkpoint["outgoing"]
+            self.status_available = self.data_outgoing is not None
+            self.data_incoming = checkpoint["incoming"] + self.data_incoming
+            self.taken = checkpoint["taken"]
+        return state
+
+    # Name of an output of the k-th dataset. A list gives the name of every dataset, 
+    # otherwise the outputs of several datasets are prefixed with the name of their input
+    def dataset_file(self, name, k):
+        if isinstance(name, list):
+            return name[k]
+        if len(self.input_names) == 1:
+            return name
+        return f"{os.path.splitext(self.input_names[k])[0]}_{name}"
+
+    # Name of an output of the k-th dataset in a normalization method. The combined mode writes the outputs 
+    # of both methods, their names get the method as a suffix (e.g. result_quantile.csv)
+    def mode_file(self, name, k, mode):
+        name = self.dataset_file(name, k)
+        if self.mode != "both":
+            return name
+        stem, extension = os.path.splitext(name)
+        return f"{stem}_{mode.replace(' ', '_')}{extension}"
+
+    # Writes the result (and the reference and the normalization factors) of every dataset for a normalization method
+    def write_outputs(self, mode, printcols, printrows):
+        for k, dataset in enumerate(self.datasets):
+            if self.save_reference and self.apply_reference is None:
+                self.metrics.call(dataset.write_reference, self.mode_file("reference.npz", k, mode), mode)
+            self.metrics.call(dataset.write_results, self.mode_file(self.output_name, k, mode), printcols, printrows,
+                              self.output_format, self.float_precision)
+            if mode == "upper quartile" and self.output_normfac:
+                self.metrics.call(dataset.write_normfac, self.dataset_file("normfactor.csv", k), self.samples[k],
+                                  self.output_format, self.float_precision)
+
+    # Reads the names of the k-th dataset from a .txt file in the input directory, one name per line
+    def read_names(self, name, k):
+        if isinstance(name, list):
+            name = name[k]
+        if name is None:
+            return None
+        with open(f"{self.INPUT_DIR}{name}", "r") as tf:
+            return tf.read().splitlines()
+
+    # Files the run writes into the output directory, they are not staged from the input
+    def output_files(self):
+        names = {"metrics.json", "profile.prof"}
+        modes = ["quantile", "upper quartile"]
+        for k, input_name in enumerate(self.input_names):
+            names.add(f"{input_name}.npy")
+            names.update(f"{input_name}.{buffer}.npy" for buffer in ("result", "sort_order", "sort_values"))
+            names.update(self.mode_file("reference.npz", k, mode) for mode in modes)
+            outputs = [self.mode_file(self.output_name, k, mode) for mode in modes] + [self.dataset_file("normfactor.csv", k)]
+            for name in outputs:
+                stem = os.path.splitext(name)[0]
+                names.add(name)
+                names.update(f"{stem}{extension}" for extension in OUTPUT_FORMATS.values())
+                names.update({f"{stem}.npz", f"{stem}.samples.txt", f"{stem}.genes.txt"})
+        return names
+
+    # Runs the app_flow, with the profile option under cProfile. The profile is written next to the output
+    def run_flow(self):
+        if not self.profile:
+            self.app_flow()
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self.app_flow)
+        finally:
+            profiler.dump_stats(f"{self.OUTPUT_DIR}profile.prof")
 
     def app_flow(self):
         # This method contains a state machine for the client and coordinator instance
@@ -107,6 +345,7 @@ class AppLogic:
         state_set_local_result = 9
         state_writing_results = 10
         state_finishing = 11
+        state_apply_reference = 12
 
         # Initial state
         state = state_initializing
@@ -114,15 +353,12 @@ class AppLogic:
 
         printcols = False
         printrows = False
+        # The names of the samples and genes of every dataset, a single file applies to all datasets
+        self.samples = [self.read_names(self.sample_names, k) for k in range(len(self.input_names))]
+        self.genes = [self.read_names(self.gene_names, k) for k in range(len(self.input_names))]
         if self.sample_names is not None:
-            colpath = f"{self.INPUT_DIR}{self.sample_names}"
-            with open(colpath,"r") as tf:
-                self.samples = tf.read().splitlines()
             printcols = True
         if self.gene_names is not None:
-            rowpath = f"{self.INPUT_DIR}{self.gene_names}"
-            with open(rowpath,"r") as tf:
-                self.genes = tf.read().splitlines()
             printrows = True
         if (self.colsrows):
             printcols = True
@@ -130,154 +366,233 @@ class AppLogic:
 
         while True:
             if state == state_initializing:
+                self.metrics.enter("initializing")
                 print("Initializing", flush=True)
+                if self.output_format not in OUTPUT_FORMATS:
+                    print(f"ERROR: unknown output_format {self.output_format} in config.yml, use one of {', '.join(OUTPUT_FORMATS)}", flush=True)
+                    exit()
+                if self.compute_dtype not in (None, "float64", "float32"):
+                    print(f"ERROR: unknown compute_dtype {self.compute_dtype} in config.yml, use float64 or float32", flush=True)
+                    exit()
+                if self.mode == "both" and self.apply_reference is not None:
+                    print("ERROR: a reference is applied for one normalization method, set normalization to quantile or upper quartile", flush=True)
+                    exit()
                 if self.id is not None:  # Test if setup has happened already
                     print(f'Coordinator: {self.coordinator}', flush=True)
-                    if self.coordinator:
-                        self.client = Coordinator()
-                    else:
-                        self.client = Client()
+                    # Links the input files into the output, large copies continue in the background
+                    self.metrics.call(self.staging.start)
+                    algo = Coordinator if self.coordinator else Client
+                    self.datasets = [algo(self.INPUT_DIR, self.OUTPUT_DIR) for _ in self.input_names]
                     state = state_read_input
             if state == state_read_input:
+                self.metrics.enter("read input")
                 print("Read input", flush=True)
                 self.progress = 'read input'
-                self.client.read_input(self.input_name,self.sep,self.samples,self.genes,self.colsrows)
-                state = state_local_computation
+                for k, dataset in enumerate(self.datasets):
+                    self.metrics.call(dataset.read_input, self.input_names[k],self.sep,self.samples[k],self.genes[k],self.colsrows,self.sparse,
+                                      self.memory_budget,self.cache_input,self.csv_engine,self.input_dtype,self.workers,self.compute_dtype,
+                                      self.compute_tolerance,self.cache_dir)
+                    for mode in (["quantile", "upper quartile"] if self.mode == "both" else [self.mode]):
+                        dataset.stream_results(mode, self.mode_file(self.output_name, k, mode), self.output_format)
+                state = state_local_computation if self.apply_reference is None else state_apply_reference
+                if self.resumed is not None:
+                    state = self.resume(self.resumed)
+
+            if state == state_apply_reference:
+                # The global values come from the reference of an earlier run, no data is exchanged
+                self.metrics.enter("apply reference")
+                print("Normalizing against the reference", flush=True)
+                self.progress = 'apply reference'
+                references = self.call_all("read_reference", [self.dataset_file(self.apply_reference, k) for k in range(len(self.datasets))],
+                                           [self.mode] * len(self.datasets))
+                if self.mode == "quantile":
+                    self.call_all("q_apply_global_means", references)
+                elif self.mode == "upper quartile":
+                    self.call_all("uq_set_global_zeros", [global_zeros for global_zeros, _ in references])
+                    self.call_all("uq_compute_uquartile")
+                    self.call_all("uq_set_global_result", [scalingfactor for _, scalingfactor in references])
+                    self.call_all("uq_compute_local_result")
+                state = state_writing_results
 
             if state == state_local_computation:
+                self.metrics.enter("local computation")
                 self.progress = 'local computation'
                 if self.mode == "quantile":
                     print("Start Quantile Normalization")
                     print("Local mean computation", flush=True)
-                    self.client.q_compute_local_means()
-
-                    data_to_send = jsonpickle.encode(self.client.local_means)
+                    self.call_all("q_compute_local_means")
                 elif self.mode == "upper quartile":
                     print("Start Upper Quartile Normalization")
                     print("Local zero computation", flush=True)
-                    self.client.uq_compute_local_zeros()
-                
-                    data_to_send = jsonpickle.encode(self.client.local_zeros)
+                    self.call_all("uq_compute_local_zeros")
+                elif self.mode == "both":
+                    print("Start Quantile and Upper Quartile Normalization")
+                    print("Local mean and zero computation", flush=True)
+                    self.call_all("qu_compute_local_statistics")
                 else:
                     print("ERROR: there was no normalization method given in config.yml")
                     exit()
 
                 if self.coordinator:
-                    self.data_incoming.append(data_to_send)
+                    # The coordinator adds its own part directly, the parts of the clients as they arrive
+                    if self.mode == "quantile":
+                        self.call_all("q_aggregate_local_means", [dataset.local_means for dataset in self.datasets])
+                    elif self.mode == "both":
+                        self.call_all("qu_aggregate_local_statistics", [[dataset.local_means, dataset.local_zeros] for dataset in self.datasets])
+                    else:
+                        self.call_all("uq_aggregate_local_zeros", [dataset.local_zeros for dataset in self.datasets])
+                    self.received = 1
                     state = state_global_aggregation
                 else:
-                    self.data_outgoing = data_to_send
+                    if self.mode == "quantile":
+                        self.data_outgoing = self.encode([dataset.local_means for dataset in self.datasets])
+                    elif self.mode == "both":
+                        self.data_outgoing = self.encode([[dataset.local_means, dataset.local_zeros] for dataset in self.datasets])
+                    else:
+                        self.data_outgoing = self.encode([dataset.local_zeros for dataset in self.datasets])
                     self.status_available = True
                     state = state_wait_for_aggregation
                     if self.mode == "quantile":
                         print(f'[CLIENT] Sending local means data to coordinator', flush=True)
                     elif self.mode == "upper quartile":
                         print(f'[CLIENT] Sending local zero lines to coordinator', flush=True)
+                    else:
+                        print(f'[CLIENT] Sending local means and zero lines to coordinator', flush=True)
+                self.save_checkpoint(state)
 
             if state == state_wait_for_aggregation:
+                self.metrics.enter("wait for aggregation")
                 print("Wait for aggregation", flush=True)
                 self.progress = 'wait for aggregation'
-                if len(self.data_incoming) > 0:
-                    if self.mode == "quantile":
-                        print("Received global means from coordinator.", flush=True)
-                        global_means = jsonpickle.decode(self.data_incoming[0])
-                        self.client.q_set_global_means(global_means)
-                    elif self.mode == "upper quartile":
-                        print("Received global zero lines from coordinator.", flush=True)
-                        global_zeros = jsonpickle.decode(self.data_incoming[0])
-                        self.client.uq_set_global_zeros(global_zeros)
-                    self.data_incoming = []
-                    state = state_local_result_computation
+                data = self.take_incoming()[0]
+                if self.mode == "quantile":
+                    print("Received global means from coordinator.", flush=True)
+                    global_means = self.decode_datasets(data)
+                    self.call_all("q_set_global_means", global_means)
+                elif self.mode == "upper quartile":
+                    print("Received global zero lines from coordinator.", flush=True)
+                    global_zeros = self.decode_datasets(data)
+                    self.call_all("uq_set_global_zeros", global_zeros)
+                elif self.mode == "both":
+                    print("Received global means and zero lines from coordinator.", flush=True)
+                    self.call_all("qu_set_global_statistics", self.decode_datasets(data))
+                state = state_local_result_computation
+                self.save_checkpoint(state)
 
             if state == state_global_aggregation:
+                self.metrics.enter("global aggregation")
                 print("Global computation", flush=True)
                 self.progress = 'global aggregation...'
-                if len(self.data_incoming) == len(self.clients):
-                    if self.mode == "quantile":
-                        local_means = [jsonpickle.decode(client_data) for client_data in self.data_incoming]             
-                        global_means = self.client.q_compute_global_means(local_means)
-                        self.client.q_set_global_means(global_means)
-                        data_to_broadcast = jsonpickle.encode(global_means)
-                    elif self.mode == "upper quartile":
-                        local_zeros = [jsonpickle.decode(client_data) for client_data in self.data_incoming]
-                        global_zeros = self.client.uq_compute_global_zeros(local_zeros)
-                        self.client.uq_set_global_zeros(global_zeros)
-                        data_to_broadcast = jsonpickle.encode(global_zeros)
-                    self.data_incoming = []
-                    self.data_outgoing = data_to_broadcast
-                    self.status_available = True
-                    state = state_local_result_computation
-                    if self.mode == "quantile":
-                        print(f'[COORDINATOR] Broadcasting global mean to clients', flush=True)
-                    elif self.mode == "upper quartile":
-                        print(f'[COORDINATOR] Broadcasting global zero lines to clients', flush=True)
+                if self.mode == "quantile":
+                    self.aggregate_incoming("q_aggregate_local_means")
+                    global_means = self.call_all("q_compute_global_means")
+                    self.call_all("q_set_global_means", global_means)
+                    data_to_broadcast = self.encode(global_means)
+                elif self.mode == "upper quartile":
+                    self.aggregate_incoming("uq_aggregate_local_zeros")
+                    global_zeros = self.call_all("uq_compute_global_zeros")
+                    self.call_all("uq_set_global_zeros", global_zeros)
+                    data_to_broadcast = self.encode(global_zeros)
+                elif self.mode == "both":
+                    self.aggregate_incoming("qu_aggregate_local_statistics")
+                    global_statistics = self.call_all("qu_compute_global_statistics")
+                    self.call_all("qu_set_global_statistics", global_statistics)
+                    data_to_broadcast = self.encode(global_statistics)
+                self.data_outgoing = data_to_broadcast
+                self.status_available = True
+                state = state_local_result_computation
+                if self.mode == "quantile":
+                    print(f'[COORDINATOR] Broadcasting global mean to clients', flush=True)
+                elif self.mode == "upper quartile":
+                    print(f'[COORDINATOR] Broadcasting global zero lines to clients', flush=True)
+                else:
+                    print(f'[COORDINATOR] Broadcasting global means and zero lines to clients', flush=True)
+                self.save_checkpoint(state)
 
             if state == state_local_result_computation:
+                self.metrics.enter("local result computation")
                 if self.mode == "quantile":
                     print("Calculating results..", flush=True)
-                    self.client.q_compute_local_result()
+                    self.call_all("q_compute_local_result")
                     state = state_writing_results
-                elif self.mode == "upper quartile":
+                else:
+                    if self.mode == "both":
+                        # The quantile result is written right away, its buffer is released before the upper quartile result
+                        print("Calculating quantile results..", flush=True)
+                        self.call_all("q_compute_local_result")
+                        self.write_outputs("quantile", printcols, printrows)
                     print("Calculating local norm factors..", flush=True)
-                    self.client.uq_compute_uquartile()
-                    data_to_send = jsonpickle.encode(self.client.uquartile)
+                    self.call_all("uq_compute_uquartile")
 
                     if self.coordinator:
-                        self.data_incoming.append(data_to_send)
+                        self.call_all("uq_aggregate_uquartile", [dataset.uquartile for dataset in self.datasets])
+                        self.received = 1
                         state = state_global_result_computation
                     else:
-                        self.data_outgoing = data_to_send
+                        self.data_outgoing = self.encode([dataset.uquartile for dataset in self.datasets])
                         self.status_available = True
                         state = state_second_wait_for_aggregation
                         print(f'[CLIENT] Sending local norm factors to coordinator', flush=True)
+                    self.save_checkpoint(state)
 
             if state == state_second_wait_for_aggregation:
+                self.metrics.enter("second wait for aggregation")
                 print("Wait for the second aggregation", flush=True)
                 self.progress = 'wait for second aggregation'
-                if len(self.data_incoming) > 0:
-                    print("Received global result from coordinator.", flush=True)
-                    global_result = jsonpickle.decode(self.data_incoming[0])
-                    self.data_incoming = []
-                    self.client.uq_set_global_result(global_result)
-                    state = state_set_local_result
+                data = self.take_incoming()[0]
+                print("Received global result from coordinator.", flush=True)
+                global_result = self.decode_datasets(data)
+                self.call_all("uq_set_global_result", global_result)
+                state = state_set_local_result
+                self.save_checkpoint(state)
 
             if state == state_global_result_computation:
+                self.metrics.enter("global result computation")
                 print("Global computation of the result", flush=True)
                 self.progress = 'global result computation...'
-                if len(self.data_incoming) == len(self.clients):
-                    local_result = []
-                    for client_data in self.data_incoming:
-                        local_result = np.append(local_result,jsonpickle.decode(client_data))
-                    self.data_incoming = []
-                    global_result = self.client.uq_compute_global_result(local_result)
-                    self.client.uq_set_global_result(global_result)
-                    data_to_broadcast = jsonpickle.encode(global_result)
-                    self.data_outgoing = data_to_broadcast
-                    self.status_available = True
-                    state = state_set_local_result
-                    print(f'[COORDINATOR] Broadcasting global result to clients', flush=True)
+                self.aggregate_incoming("uq_aggregate_uquartile")
+                global_result = self.call_all("uq_compute_global_result")
+                self.call_all("uq_set_global_result", global_result)
+                data_to_broadcast = self.encode(global_result)
+                self.data_outgoing = data_to_broadcast
+                self.status_available = True
+                state = state_set_local_result
+                print(f'[COORDINATOR] Broadcasting global result to clients', flush=True)
+                self.save_checkpoint(state)
 
             if state == state_set_local_result:
+                self.metrics.enter("set local result")
                 print("Calculating results..", flush=True)
-                self.client.uq_compute_local_result()
+                self.call_all("uq_compute_local_result")
                 state = state_writing_results
 
             if state == state_writing_results:
+                self.metrics.enter("writing results")
                 print("Writing results", flush=True)
+                deviations = {self.input_names[k]: dataset.deviation for k, dataset in enumerate(self.datasets)
+                              if dataset.deviation is not None}
+                if deviations:
+                    self.metrics.info["deviation_from_float64"] = deviations
                 # now you can save it to a file
-                self.client.write_results(self.output_name, printcols, printrows)
-                if self.mode == "upper quartile" and self.output_normfac:
-                    self.client.write_normfac("normfactor.csv", self.samples)
+                self.write_outputs("upper quartile" if self.mode == "both" else self.mode, printcols, printrows)
                 state = state_finishing
+                # The outputs are written, only the last broadcast of the coordinator may still be pending
+                self.save_checkpoint(state, datasets=False)
 
             if state == state_finishing:
+                self.metrics.enter("finishing")
                 print("Finishing", flush=True)
                 self.progress = 'finishing...'
                 if self.coordinator:
-                    time.sleep(10)
+                    # The clients still need the last broadcast, finish once it has been fetched
+                    self.wait_for(lambda: not self.status_available)
+                # The output is complete once the input files copied in the background are there
+                self.metrics.call(self.staging.wait)
+                self.metrics.enter(None)
+                self.metrics.write(f"{self.OUTPUT_DIR}metrics.json")
+                if self.checkpoint is not None:
+                    self.checkpoint.remove()
                 self.status_finished = True
                 break
-            
-            time.sleep(1)
 
 logic = AppLogic()
@@ -0,0 +1,92 @@
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#Records where the time of a run goes. Every state of the app_flow and every kernel of algo.py
+#that is called in it gets a record with its wall time, CPU time, memory and the bytes of the
+#payloads sent and received meanwhile.
+#cpu_s is the CPU time of the whole process (worker threads included), thread_cpu_s the CPU time
+#of the app_flow thread only. peak_rss_bytes is the highest resident memory of the process up to
+#the end of the record, rss_bytes the resident memory at that point.
+
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        return None
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Metrics:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.records = []
+        self.state = None
+        # Further facts about the run, e.g. the precision of the result
+        self.info = {}
+        self.lock = threading.Lock()
+
+    def _open(self, name, kind, state=None):
+        return {"name": name, "kind": kind, "state": state,
+                "start_s": time.perf_counter() - self.start, "wall_s": None, "cpu_s": None, "thread_cpu_s": None,
+                "rss_bytes": None, "peak_rss_bytes": None, "bytes_sent": 0, "bytes_received": 0,
+                "_wall": time.perf_counter(), "_cpu": time.process_time(), "_thread_cpu": time.thread_time()}
+
+    def _close(self, record):
+        record["wall_s"] = time.perf_counter() - record.pop("_wall")
+        record["cpu_s"] = time.process_time() - record.pop("_cpu")
+        record["thread_cpu_s"] = time.thread_time() - record.pop("_thread_cpu")
+        record["rss_bytes"] = _rss()
+        record["peak_rss_bytes"] = _peak_rss()
+        with self.lock:
+            self.records.append(record)
+
+    # Ends the record of the current state and starts the one of the next state, None ends the last state
+    def enter(self, state):
+        if self.state is not None:
+            self._close(self.state)
+        self.state = self._open(state, "state") if state is not None else None
+
+    # Calls a kernel and records it as part of the current state
+    def call(self, func, *args, **kwargs):
+        record = self._open(func.__name__, "kernel", self.state["name"] if self.state is not None else None)
+        result = func(*args, **kwargs)
+        self._close(record)
+        return result
+
+    # Adds the size of a payload to the current state
+    def add_bytes(self, key, nbytes):
+        if self.state is not None:
+            self.state[key] += nbytes
+
+    def report(self):
+        with self.lock:
+            records = [dict(record) for record in self.records]
+        current = self.state
+        return {
+            "elapsed_s": time.perf_counter() - self.start,
+            "current_state": current["name"] if current is not None else None,
+            "peak_rss_bytes": _peak_rss(),
+            "info": dict(self.info),
+            "records": records,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,12 @@
+import socketserver
+from wsgiref.simple_server import WSGIServer
+
+#The default wsgiref server of bottle handles one request after the other, so the /status polls of the 
+#controller wait while a large payload is transferred through /data. This server handles every request 
+#in a thread of its own. The handlers only hand data to the app_flow thread under its condition, 
+#so they are safe to run concurrently.
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    # Threads of requests that are still running do not keep the app from exiting
+    daemon_threads = True
@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+
+#Brings the files of the input directory into the output directory, which used to be a full copy
+#of the input before the computation started. Per file the cheapest way the filesystem allows is used:
+#   1. a hardlink (same filesystem and mount, nothing is copied),
+#   2. a reflink (copy-on-write clone, e.g. on btrfs or xfs),
+#   3. a copy, right away for small files and in a background thread for large ones,
+#      so that copying the count matrix overlaps with the computation.
+#Hidden files (the parsed input caches) and files the run writes itself are left out, a hardlink
+#to an input file must never be overwritten by an output.
+
+# ioctl request of Linux to clone the extents of one file into another
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+class Staging:
+
+    def __init__(self, input_dir, output_dir, exclude=(), copy_all=True, background_size=2**20):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.exclude = set(exclude)
+        # Without copy_all only the config and the small files next to it are staged, not the count matrices
+        self.copy_all = copy_all
+        self.background_size = background_size
+        self.pending = []
+        self.thread = None
+        self.stats = {"linked": 0, "reflinked": 0, "copied": 0, "background": 0, "skipped": 0}
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.input_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                src = os.path.join(root, name)
+                rel = os.path.relpath(src, self.input_dir)
+                if name.startswith(".") or rel in self.exclude:
+                    self.stats["skipped"] += 1
+                    continue
+                yield src, os.path.join(self.output_dir, rel)
+
+    def start(self):
+        for src, dst in self._files():
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                continue
+            size = os.path.getsize(src)
+            if not self.copy_all and size > self.background_size:
+                self.stats["skipped"] += 1
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+                self.stats["linked"] += 1
+                continue
+            except OSError:
+                pass
+            if _reflink(src, dst):
+                self.stats["reflinked"] += 1
+            elif size > self.background_size:
+                self.pending.append((src, dst))
+                self.stats["background"] += 1
+            else:
+                shutil.copy2(src, dst)
+                self.stats["copied"] += 1
+        if self.pending:
+            self.thread = threading.Thread(target=self._copy_pending, daemon=True)
+            self.thread.start()
+        print(f'Staged the input: {self.stats}', flush=True)
+
+    def _copy_pending(self):
+        for src, dst in self.pending:
+            try:
+                shutil.copy2(src, dst)
+            except OSError as e:
+                print(f'WARNING: {src} could not be copied to the output: {e}', flush=True)
+
+    # Blocks until the background copies are done
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,165 @@
+import io
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+#Binary format of the payloads exchanged between the clients and the coordinator.
+#
+#A payload starts with a fixed header:
+#   magic (4 bytes) | version (u8) | flags (u8) | reserved (u16) | body length (u64)
+#followed by the body, which is zlib compressed if FLAG_COMPRESSED is set.
+#The body is a single value, which is either a list of values or an array:
+#   list:  TAG_LIST (u8) | count (u32) | values ...
+#   array: TAG_ARRAY (u8) | encoding (u8) | dtype (3 bytes, e.g. '<f8') | ndim (u8) | shape (u64 * ndim)
+#          | data length (u64) | padding to 8 bytes | data
+#Scalars are sent as arrays with ndim 0. All numbers are little-endian.
+#Array data is aligned to 8 bytes, so that raw arrays of an uncompressed payload
+#are decoded without copying them.
+
+MAGIC = b"UQQN"
+VERSION = 1
+
+FLAG_COMPRESSED = 1
+
+TAG_LIST = 0
+TAG_ARRAY = 1
+
+#The values as they are.
+ENCODING_RAW = 0
+#Each float64 value XORed with its predecessor. Neighbouring values of a sorted vector
+#share sign, exponent and leading mantissa bits, so the XORs start with many zero bits
+#which compress well. Unlike a difference of floats, this is lossless.
+ENCODING_XOR_DELTA = 1
+#A sorted set of row indices as a packed bitmap over the rows 0 ... max index.
+ENCODING_BITMAP = 2
+
+HEADER = struct.Struct("<4sBBHQ")
+ARRAY_HEADER = struct.Struct("<BB3sB")
+
+#Payloads up to this size are read into memory, larger ones are spooled to a temporary file.
+SPOOL_SIZE = 2**20
+
+
+def encode(obj, compress=False):
+    parts = []
+    _encode_value(obj, parts, compress)
+    body = b"".join(parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_COMPRESSED
+    return HEADER.pack(MAGIC, VERSION, flags, 0, len(body)) + body
+
+
+def decode(payload):
+    payload = memoryview(payload)
+    magic, version, flags, _, length = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC:
+        raise ValueError("payload is not in the binary wire format")
+    if version != VERSION:
+        raise ValueError(f"unsupported wire format version {version}")
+    body = payload[HEADER.size:HEADER.size + length]
+    if flags & FLAG_COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+    value, _ = _decode_value(body, 0)
+    return value
+
+
+#Reads a payload from a stream (e.g. the body of a request) without holding it in memory twice. 
+#A payload that is in a file already (the server spooled the request body to disk) is memory mapped, 
+#a large payload of any other stream is copied block by block into a temporary file first. 
+#decode reads the raw arrays of a mapped payload without copying them.
+def read_payload(stream):
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is not None and os.fstat(fileno).st_size > SPOOL_SIZE:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    head = stream.read(SPOOL_SIZE + 1)
+    if len(head) <= SPOOL_SIZE:
+        return head
+    with tempfile.TemporaryFile() as f:
+        f.write(head)
+        del head
+        shutil.copyfileobj(stream, f, SPOOL_SIZE)
+        f.flush()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _is_index_set(arr):
+    return arr.ndim == 1 and arr.size > 0 and arr.dtype.kind in "iu" and arr[0] >= 0 \
+        and bool(np.all(arr[1:] > arr[:-1]))
+
+
+def _encode_value(obj, parts, compress):
+    if isinstance(obj, (list, tuple)):
+        parts.append(struct.pack("<BI", TAG_LIST, len(obj)))
+        for item in obj:
+            _encode_value(item, parts, compress)
+        return
+
+    arr = np.asarray(obj)
+    #The header has room for a dtype string of 3 characters, only plain numbers and booleans are sent.
+    if arr.dtype.kind not in "biuf" or len(arr.dtype.str) > 3:
+        raise ValueError(f"the wire format cannot encode arrays of dtype {arr.dtype}")
+    arr = arr.astype(arr.dtype.newbyteorder("<"), order="C", copy=False)
+    encoding = ENCODING_RAW
+    data = arr
+    if _is_index_set(arr) and (int(arr[-1]) + 8) // 8 < arr.nbytes:
+        encoding = ENCODING_BITMAP
+        mask = np.zeros(int(arr[-1]) + 1, dtype=bool)
+        mask[arr] = True
+        data = np.packbits(mask)
+    elif compress and arr.ndim == 1 and arr.size > 1 and arr.dtype == np.dtype("<f8") \
+            and bool(np.all(arr[1:] >= arr[:-1])):
+        encoding = ENCODING_XOR_DELTA
+        bits = arr.view("<u8")
+        data = np.empty_like(bits)
+        data[0] = bits[0]
+        np.bitwise_xor(bits[1:], bits[:-1], out=data[1:])
+
+    header = ARRAY_HEADER.pack(TAG_ARRAY, encoding, arr.dtype.str.encode(), arr.ndim)
+    header += struct.pack(f"<{arr.ndim}QQ", *arr.shape, data.nbytes)
+    offset = sum(len(part) for part in parts) + len(header)
+    header += b"\0" * (-offset % 8)
+    parts.append(header)
+    parts.append(data.tobytes())
+
+
+def _decode_value(body, offset):
+    tag = body[offset]
+    if tag == TAG_LIST:
+        _, count = struct.unpack_from("<BI", body, offset)
+        offset += struct.calcsize("<BI")
+        values = []
+        for _ in range(count):
+            value, offset = _decode_value(body, offset)
+            values.append(value)
+        return values, offset
+
+    _, encoding, dtype, ndim = ARRAY_HEADER.unpack_from(body, offset)
+    offset += ARRAY_HEADER.size
+    *shape, length = struct.unpack_from(f"<{ndim}QQ", body, offset)
+    offset += struct.calcsize(f"<{ndim}QQ")
+    offset += -offset % 8
+    dtype = np.dtype(dtype.decode())
+    data = body[offset:offset + length]
+    offset += length
+
+    if encoding == ENCODING_BITMAP:
+        mask = np.unpackbits(np.frombuffer(data, dtype=np.uint8)).astype(bool)
+        arr = np.flatnonzero(mask).astype(dtype)
+    elif encoding == ENCODING_XOR_DELTA:
+        bits = np.bitwise_xor.accumulate(np.frombuffer(data, dtype="<u8"))
+        arr = bits.view(dtype)
+    else:
+        arr = np.frombuffer(data, dtype=dtype).reshape(shape)
+    if ndim == 0:
+        return arr[()], offset
+    return arr, offset
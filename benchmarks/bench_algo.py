@@ -0,0 +1,214 @@
+"""Benchmarks the kernels of app/algo.py on synthetic read count matrices.
+
+Every method of Client and Coordinator is timed and memory profiled on its own, the results are
+written as JSON, so that they can be compared between versions.
+
+    python benchmarks/bench_algo.py --genes 60000 --samples 200 --sparsity 0.5 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import scipy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import algo
+from app.algo import Client, Coordinator
+
+
+#Generates a genes x samples matrix of read counts. The gene means are log-normal, every sample
+#has its own library size and the counts are negative binomial around the resulting means.
+#A fraction `sparsity` of the counts is set to zero (dropouts) and a fraction `nan_rate` to NaN.
+def generate_counts(genes, samples, sparsity=0.0, nan_rate=0.0, dispersion=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    gene_means = rng.lognormal(mean=3.0, sigma=2.0, size=(genes, 1))
+    library_sizes = rng.lognormal(mean=0.0, sigma=0.3, size=(1, samples))
+    mu = gene_means * library_sizes
+    r = 1.0 / dispersion
+    counts = rng.negative_binomial(r, r / (r + mu))
+    if sparsity > 0:
+        counts[rng.random(counts.shape) < sparsity] = 0
+    if nan_rate > 0:
+        counts = counts.astype(np.float64)
+        counts[rng.random(counts.shape) < nan_rate] = np.nan
+    return counts
+
+
+#Calls func and returns its wall time and CPU time, or the peak of the memory allocated meanwhile.
+#Tracing the allocations slows down the Python parts of a step a lot (e.g. writing the CSV),
+#so time and memory are measured in separate runs.
+def measure(func, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"peak_bytes": peak}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    func()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    return {"wall_s": wall, "cpu_s": cpu}
+
+
+def read_options(args):
+    return dict(memory_budget=args.memory_budget, workers=args.workers, sparse=args.sparse,
+                dtype=args.input_dtype, compute_dtype=args.compute_dtype)
+
+
+#One run of quantile normalization, every step as it is called by the app_flow.
+def run_quantile(args, trace_memory=False):
+    client = Client()
+    coordinator = Coordinator()
+    steps = [
+        ("read_input", lambda: client.read_input("data.csv", ",", None, None, True, **read_options(args))),
+        ("q_compute_local_means", client.q_compute_local_means),
+        ("q_aggregate_local_means", lambda: coordinator.q_aggregate_local_means(client.local_means)),
+        ("q_compute_global_means", lambda: client.q_set_global_means(coordinator.q_compute_global_means())),
+        ("q_compute_local_result", client.q_compute_local_result),
+        ("write_reference", lambda: client.write_reference("reference.npz", "quantile")),
+        ("write_results", lambda: client.write_results("result.csv", True, True)),
+    ]
+    return [(name, measure(step, trace_memory)) for name, step in steps]
+
+
+#Normalizes the input against the reference of a quantile run, locally without a federated round.
+def run_quantile_reference(args, trace_memory=False):
+    if not os.path.exists(f"{algo.INPUT_PATH}reference.npz"):
+        run_quantile(args)
+    client = Client()
+    references = []
+    steps = [
+        ("read_input", lambda: client.read_input("data.csv", ",", None, None, True, **read_options(args))),
+        ("read_reference", lambda: references.append(client.read_reference("reference.npz", "quantile"))),
+        ("q_apply_global_means", lambda: client.q_apply_global_means(references[0])),
+        ("write_results", lambda: client.write_results("result.csv", True, True)),
+    ]
+    return [(name, measure(step, trace_memory)) for name, step in steps]
+
+
+#One run of upper quartile normalization, every step as it is called by the app_flow.
+def run_upper_quartile(args, trace_memory=False):
+    client = Client()
+    coordinator = Coordinator()
+    steps = [
+        ("read_input", lambda: client.read_input("data.csv", ",", None, None, True, **read_options(args))),
+        ("uq_compute_local_zeros", client.uq_compute_local_zeros),
+        ("uq_aggregate_local_zeros", lambda: coordinator.uq_aggregate_local_zeros(client.local_zeros)),
+        ("uq_compute_global_zeros", lambda: client.uq_set_global_zeros(coordinator.uq_compute_global_zeros())),
+        ("uq_compute_uquartile", client.uq_compute_uquartile),
+        ("uq_aggregate_uquartile", lambda: coordinator.uq_aggregate_uquartile(client.uquartile)),
+        ("uq_compute_global_result", lambda: client.uq_set_global_result(coordinator.uq_compute_global_result())),
+        ("uq_compute_local_result", client.uq_compute_local_result),
+        ("write_results", lambda: client.write_results("result.csv", True, True)),
+        ("write_normfac", lambda: client.write_normfac("normfactor.csv")),
+    ]
+    return [(name, measure(step, trace_memory)) for name, step in steps]
+
+
+#One run of the combined mode: both normalizations from one sort of every column.
+def run_both(args, trace_memory=False):
+    client = Client()
+    coordinator = Coordinator()
+    steps = [
+        ("read_input", lambda: client.read_input("data.csv", ",", None, None, True, **read_options(args))),
+        ("qu_compute_local_statistics", client.qu_compute_local_statistics),
+        ("qu_aggregate_local_statistics", lambda: coordinator.qu_aggregate_local_statistics([client.local_means, client.local_zeros])),
+        ("qu_compute_global_statistics", lambda: client.qu_set_global_statistics(coordinator.qu_compute_global_statistics())),
+        ("q_compute_local_result", client.q_compute_local_result),
+        ("write_results_quantile", lambda: client.write_results("result_quantile.csv", True, True)),
+        ("qu_compute_uquartile", client.qu_compute_uquartile),
+        ("uq_aggregate_uquartile", lambda: coordinator.uq_aggregate_uquartile(client.uquartile)),
+        ("uq_compute_global_result", lambda: client.uq_set_global_result(coordinator.uq_compute_global_result())),
+        ("uq_compute_local_result", client.uq_compute_local_result),
+        ("write_results_upper_quartile", lambda: client.write_results("result_upper_quartile.csv", True, True)),
+        ("write_normfac", lambda: client.write_normfac("normfactor.csv")),
+    ]
+    return [(name, measure(step, trace_memory)) for name, step in steps]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--genes", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--sparsity", type=float, default=0.0, help="fraction of counts set to zero")
+    parser.add_argument("--nan-rate", type=float, default=0.0, help="fraction of counts set to NaN (quantile only)")
+    parser.add_argument("--dispersion", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the fastest run of each step is reported")
+    parser.add_argument("--modes", nargs="+", default=["quantile", "upper quartile", "both", "quantile reference"],
+                        choices=["quantile", "upper quartile", "both", "quantile reference"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--memory-budget", type=float, default=None)
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--input-dtype", default=None, help="dtype the input is parsed as, e.g. float32")
+    parser.add_argument("--compute-dtype", choices=["float64", "float32"], default=None)
+    parser.add_argument("--output", default=None, help="file the JSON results are written to, default is stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="uq_q_bench_")
+    algo.INPUT_PATH = algo.OUTPUT_PATH = f"{workdir}/"
+    counts = generate_counts(args.genes, args.samples, args.sparsity, args.nan_rate, args.dispersion, args.seed)
+    pd.DataFrame(counts, index=[f"gene{i}" for i in range(args.genes)],
+                 columns=[f"sample{j}" for j in range(args.samples)]).to_csv(f"{workdir}/data.csv")
+
+    runs = {"quantile": run_quantile, "upper quartile": run_upper_quartile, "both": run_both,
+            "quantile reference": run_quantile_reference}
+    results = []
+    for mode in args.modes:
+        if mode in ("upper quartile", "both") and args.nan_rate > 0:
+            print(f"Skipping {mode} normalization, it can't handle NaNs.", file=sys.stderr)
+            continue
+        if mode != "upper quartile" and args.sparse:
+            print(f"Skipping {mode} normalization, it has no sparse backend.", file=sys.stderr)
+            continue
+        best = {}
+        for _ in range(args.repeat):
+            for name, stats in runs[mode](args):
+                if name not in best or stats["wall_s"] < best[name]["wall_s"]:
+                    best[name] = stats
+        for name, stats in runs[mode](args, trace_memory=True):
+            best[name].update(stats)
+        results.extend({"mode": mode, "method": name, **stats} for name, stats in best.items())
+
+    report = {
+        "parameters": vars(args),
+        "environment": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "scipy": scipy.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""Simulates a federation of one coordinator and N clients on the local machine.
+
+Every site is an AppLogic with its own input and output directory and a synthetic read count
+matrix. The script takes the part of the FeatureCloud controller: it sets the sites up, polls
+their status and relays the data between the clients and the coordinator through the same
+/setup, /status and /data protocol. The sites either run in this process (--transport local),
+or behind their own Bottle API server on a local port (--transport http).
+
+The latency and the bytes exchanged of every round and the total wall time are written as JSON.
+
+    python benchmarks/simulate.py --sites 2 10 50 200 --mode "upper quartile" --output sim.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+import pandas as pd
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.api_ctrl import create_api_server
+from app.logic import APP_NAME, AppLogic
+from app.server import ThreadingWSGIServer
+from bench_algo import generate_counts, git_revision
+
+
+#A site whose AppLogic runs in this process, the controller calls its handlers directly.
+class LocalSite:
+    def __init__(self, input_dir, output_dir):
+        self.logic = AppLogic(input_dir, output_dir)
+
+    def setup(self, client_id, master, clients):
+        self.logic.handle_setup(client_id, master, clients)
+
+    def status(self):
+        return {"available": self.logic.status_available, "finished": self.logic.status_finished}
+
+    def get_data(self):
+        return self.logic.handle_outgoing()
+
+    def post_data(self, data):
+        self.logic.handle_incoming(io.BytesIO(data))
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+#A site that is served by its own controller API on a local port, the controller talks HTTP to it.
+class HttpSite:
+    def __init__(self, input_dir, output_dir):
+        self.logic = AppLogic(input_dir, output_dir)
+        self.httpd = make_server("127.0.0.1", 0, create_api_server(self.logic), ThreadingWSGIServer, QuietHandler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def request(self, method, path, data=None, content_type="application/octet-stream"):
+        req = urllib.request.Request(f"{self.url}{path}", data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", content_type)
+        with urllib.request.urlopen(req) as response:
+            return response.read()
+
+    def setup(self, client_id, master, clients):
+        payload = json.dumps({"id": client_id, "master": master, "clients": clients}).encode()
+        self.request("POST", "/setup", payload, "application/json")
+
+    def status(self):
+        return json.loads(self.request("GET", "/status"))
+
+    def get_data(self):
+        return self.request("GET", "/data")
+
+    def post_data(self, data):
+        self.request("POST", "/data", data)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+#Creates the input directory of every site with its part of the data and a config.yml.
+def create_sites(workdir, args, n):
+    dirs = []
+    for i in range(n):
+        input_dir = f"{workdir}/site{i}/input/"
+        output_dir = f"{workdir}/site{i}/output/"
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        counts = generate_counts(args.genes, args.samples, args.sparsity, 0.0, args.dispersion, args.seed + i)
+        pd.DataFrame(counts, index=[f"gene{g}" for g in range(args.genes)],
+                     columns=[f"site{i}_sample{j}" for j in range(args.samples)]).to_csv(f"{input_dir}data.csv")
+        config = {
+            "normalization": args.mode,
+            "input_filename": "data.csv",
+            "output_filename": "result.csv",
+            "sample_genes_in_input": True,
+            "normfactors": args.mode != "quantile",
+            "compress_payloads": args.compress_payloads,
+            "sparse": args.sparse,
+            "workers": args.workers,
+        }
+        with open(f"{input_dir}config.yml", "w") as f:
+            yaml.dump({APP_NAME: config}, f)
+        dirs.append((input_dir, output_dir))
+    return dirs
+
+
+#Plays the controller until all sites are finished. The data of a client is relayed to the coordinator,
+#the data of the coordinator is broadcast to all clients, which ends a round.
+def run_federation(sites, poll_interval, timeout):
+    coordinator, clients = sites[0], sites[1:]
+    ids = [str(i) for i in range(len(sites))]
+    start = time.perf_counter()
+    for i, site in enumerate(sites):
+        site.setup(ids[i], i == 0, ids)
+
+    rounds = []
+    round_start = start
+    last_upload = None
+    uploads = 0
+    upload_bytes = 0
+    finished = set()
+    while len(finished) < len(sites):
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"the federation did not finish within {timeout} s, {len(finished)} of {len(sites)} sites finished")
+        idle = True
+        for i, site in enumerate(sites):
+            if i in finished:
+                continue
+            status = site.status()
+            if status["available"]:
+                idle = False
+                data = site.get_data()
+                if site is coordinator:
+                    for client in clients:
+                        client.post_data(data)
+                    now = time.perf_counter()
+                    rounds.append({
+                        "round": len(rounds) + 1,
+                        "latency_s": now - round_start,
+                        "aggregation_s": now - last_upload if last_upload is not None else None,
+                        "uploads": uploads,
+                        "upload_bytes": upload_bytes,
+                        "broadcast_bytes": len(data) * len(clients),
+                    })
+                    round_start = now
+                    last_upload = None
+                    uploads = 0
+                    upload_bytes = 0
+                else:
+                    coordinator.post_data(data)
+                    last_upload = time.perf_counter()
+                    uploads += 1
+                    upload_bytes += len(data)
+            elif status["finished"]:
+                finished.add(i)
+        if idle:
+            time.sleep(poll_interval)
+
+    wall = time.perf_counter() - start
+    return {
+        "sites": len(sites),
+        "wall_s": wall,
+        "bytes_exchanged": sum(r["upload_bytes"] + r["broadcast_bytes"] for r in rounds),
+        "rounds": rounds,
+    }
+
+
+def simulate(args, n):
+    workdir = tempfile.mkdtemp(prefix=f"uq_q_sim_{n}_")
+    dirs = create_sites(workdir, args, n)
+    transport = {"local": LocalSite, "http": HttpSite}[args.transport]
+    sites = [transport(input_dir, output_dir) for input_dir, output_dir in dirs]
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with log:
+            result = run_federation(sites, args.poll_interval, args.timeout)
+    finally:
+        for site in sites:
+            site.close()
+    result["workdir"] = workdir
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, nargs="+", default=[2, 10, 50], help="numbers of sites to simulate, coordinator included")
+    parser.add_argument("--transport", choices=["local", "http"], default="local")
+    parser.add_argument("--mode", choices=["quantile", "upper quartile", "both"], default="quantile")
+    parser.add_argument("--genes", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=10, help="number of samples of every site")
+    parser.add_argument("--sparsity", type=float, default=0.0, help="fraction of counts set to zero")
+    parser.add_argument("--dispersion", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compress-payloads", action="store_true")
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=0.001, help="seconds the controller waits when no site has data")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds after which a simulation is aborted")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the sites")
+    parser.add_argument("--output", default=None, help="file the JSON results are written to, default is stdout")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sites:
+        if n < 2:
+            parser.error("a federation needs at least 2 sites")
+        results.append(simulate(args, n))
+        print(f"{n} sites: {results[-1]['wall_s']:.3f} s", file=sys.stderr)
+
+    report = {
+        "parameters": vars(args),
+        "environment": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.interpolate
+import scipy.stats
+
+from app import algo
+
+
+def client(X, **options):
+    c = algo.Client()
+    c.input_data = pd.DataFrame(X)
+    c.integer_counts = algo._is_count_matrix(c.input_data)
+    for name, value in options.items():
+        setattr(c, name, value)
+    return c
+
+
+def with_nans(X, rng, rate=0.1):
+    X = X.astype(np.float64)
+    X[rng.random(X.shape) < rate] = np.nan
+    return X
+
+
+# The local means as q_compute_local_means computed them before it was vectorized:
+# every column is sorted and interpolated onto the grid with its own interp1d
+def reference_local_means(X):
+    n, m = X.shape
+    i = np.arange(n)/(n-1)
+    Sort = np.empty((n, m))
+    nobs = np.full(m, n)
+    for j in range(m):
+        col = np.sort(X[:,j])
+        nobs[j] = n - np.count_nonzero(np.isnan(col))
+        if nobs[j] < n:
+            col = col[~np.isnan(col)]
+            col = scipy.interpolate.interp1d(np.arange(nobs[j])/(nobs[j]-1), col)(i)
+        Sort[:,j] = col
+    return np.sum(Sort, axis=1), nobs
+
+
+MATRICES = {
+    "float": lambda rng: rng.normal(size=(60, 7)),
+    "ties": lambda rng: rng.integers(0, 5, size=(60, 7)).astype(np.float64),
+    "nan": lambda rng: with_nans(rng.normal(size=(60, 7)), rng),
+    "nan_ties": lambda rng: with_nans(rng.integers(0, 5, size=(60, 7)), rng, 0.3),
+}
+
+
+@pytest.mark.parametrize("name", sorted(MATRICES))
+def test_interpolate_sorted_matches_interp1d(name):
+    X = MATRICES[name](np.random.default_rng(1))
+    Sort = np.sort(X, axis=0)
+    nobs = X.shape[0] - np.count_nonzero(np.isnan(X), axis=0)
+    algo._interpolate_sorted(Sort, nobs)
+    means, _ = reference_local_means(X)
+    np.testing.assert_allclose(Sort.sum(axis=1), means, rtol=1e-12)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+@pytest.mark.parametrize("name", sorted(MATRICES))
+def test_local_means_match_reference(name, workers):
+    X = MATRICES[name](np.random.default_rng(2))
+    c = client(X, workers=workers)
+    c.q_compute_local_means()
+    means, nobs = reference_local_means(X)
+    assert c.local_means[0] == X.shape[1]
+    np.testing.assert_allclose(c.local_means[1], means, rtol=1e-12)
+    assert np.array_equal(c.nobs, nobs)
+
+
+@pytest.mark.parametrize("observed", [0, 1])
+def test_samples_without_two_observations_are_rejected(observed, capsys):
+    X = np.arange(40, dtype=np.float64).reshape(10, 4)
+    X[observed:,2] = np.nan
+    c = client(X)
+    with pytest.raises(SystemExit):
+        c.q_compute_local_means()
+    assert "ERROR" in capsys.readouterr().out
+    assert c.local_means is None
+
+
+# NaNs are sorted last, so the observed values of a column have the ranks they have among themselves
+def reference_ranks(X):
+    ranks = np.full(X.shape, np.nan)
+    for j in range(X.shape[1]):
+        isna = np.isnan(X[:,j])
+        ranks[~isna,j] = scipy.stats.rankdata(X[~isna,j], method="average")
+    return ranks
+
+
+# The result as q_compute_local_result computed it before it was vectorized:
+# the ranks of every column and an interp1d of the global means
+def reference_result(X, nobs, global_means):
+    n, m = X.shape
+    f = scipy.interpolate.interp1d(np.arange(n)/(n-1), global_means)
+    result = X.copy()
+    ranks = reference_ranks(X)
+    for j in range(m):
+        isna = np.isnan(X[:,j])
+        result[~isna,j] = f((ranks[~isna,j]-1)/(nobs[j]-1))
+    return result
+
+
+@pytest.mark.parametrize("name", sorted(MATRICES))
+def test_average_ranks_match_rankdata(name):
+    X = MATRICES[name](np.random.default_rng(3))
+    assert np.array_equal(algo._average_ranks(X), reference_ranks(X), equal_nan=True)
+    assert np.array_equal(algo._average_ranks(np.ascontiguousarray(X)), reference_ranks(X), equal_nan=True)
+
+
+@pytest.mark.parametrize("name", sorted(MATRICES))
+def test_average_ranks_from_cached_sort(name):
+    X = MATRICES[name](np.random.default_rng(4))
+    order = np.argsort(X, axis=0)
+    values = np.take_along_axis(X, order, axis=0)
+    ranks = algo._average_ranks(X, order, values)
+    assert np.array_equal(ranks, reference_ranks(X), equal_nan=True)
+    # The cached argsort is not changed
+    assert np.array_equal(order, np.argsort(X, axis=0))
+    assert np.array_equal(algo._average_ranks(X, order), ranks, equal_nan=True)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+@pytest.mark.parametrize("name", sorted(MATRICES))
+def test_local_result_matches_reference(name, workers):
+    X = MATRICES[name](np.random.default_rng(5))
+    c = client(X, workers=workers)
+    c.q_compute_local_means()
+    global_means = c.local_means[1]/c.local_means[0]
+    c.q_set_global_means(global_means)
+    c.q_compute_local_result()
+    expected = reference_result(X, c.nobs, global_means)
+    np.testing.assert_allclose(c.result.to_numpy(), expected, rtol=1e-12, atol=1e-12)
+    assert np.array_equal(np.isnan(c.result.to_numpy()), np.isnan(X))
+
+
+def counts(rng, n=80, m=9, high=20):
+    return rng.negative_binomial(1, 1/high, size=(n, m))
+
+
+def test_count_ranks_match_rankdata():
+    X = counts(np.random.default_rng(6))
+    assert algo._counting_pays_off(X)
+    assert np.array_equal(algo._count_ranks(X), reference_ranks(X.astype(np.float64)))
+
+
+def test_count_histograms_in_blocks(monkeypatch):
+    X = counts(np.random.default_rng(7))
+    ranks = algo._count_ranks(X)
+    quartiles = algo._count_quantile(X, 0.75)
+    # Histograms of one or two columns at a time give the same result
+    histograms = algo._count_histograms
+    monkeypatch.setattr(algo, "_count_histograms", lambda c: histograms(c, max_bins=2*(int(c.max())+1)))
+    assert np.array_equal(algo._count_ranks(X), ranks)
+    assert np.array_equal(algo._count_quantile(X, 0.75), quartiles)
+
+
+@pytest.mark.parametrize("q", [0, 0.1, 0.5, 0.75, 0.9, 1])
+@pytest.mark.parametrize("n", [2, 7, 80])
+def test_count_quantile_matches_np_quantile(q, n):
+    X = counts(np.random.default_rng(n), n=n)
+    assert np.array_equal(algo._count_quantile(X, q), np.quantile(X, q, axis=0))
+
+
+# _lerp repeats the interpolation of numpy's quantile, a change of it in numpy shows up here
+@pytest.mark.parametrize("q", [0.1, 0.25, 0.5, 0.75, 0.9])
+def test_lerp_matches_np_quantile(q):
+    X = np.random.default_rng(8).lognormal(3, 2, size=(101, 50))
+    Sort = np.sort(X, axis=0)
+    h = q*(X.shape[0]-1)
+    k = int(np.floor(h))
+    assert np.array_equal(algo._lerp(Sort[k], Sort[k+1], np.asanyarray(h - k)), np.quantile(X, q, axis=0))
+
+
+def test_counting_only_pays_off_for_small_counts():
+    assert algo._counting_pays_off(np.array([[0], [1], [3]]))
+    assert not algo._counting_pays_off(np.array([[0], [1], [6]]))
+    assert not algo._counting_pays_off(np.empty((0, 3), dtype=np.int64))
+
+
+@pytest.mark.parametrize("high", [5, 10**6])
+def test_integer_branch_of_map_ranks(high):
+    X = counts(np.random.default_rng(9), high=high)
+    nobs = np.full(X.shape[1], X.shape[0])
+    global_means = np.sort(np.random.default_rng(10).normal(size=X.shape[0]))
+    assert np.array_equal(algo._map_ranks(X, nobs, global_means, integer_counts=True),
+                          algo._map_ranks(X.astype(np.float64), nobs, global_means))
+
+
+UQ_MATRICES = {
+    "float": lambda rng: rng.lognormal(2, 1, size=(60, 7)),
+    "negative": lambda rng: rng.normal(size=(60, 7)),
+    "counts": lambda rng: counts(rng, n=60, m=7),
+    "large_counts": lambda rng: counts(rng, n=60, m=7, high=10**6),
+}
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+@pytest.mark.parametrize("name", sorted(UQ_MATRICES))
+def test_upper_quartiles_match_np_quantile(name, workers):
+    rng = np.random.default_rng(11)
+    X = UQ_MATRICES[name](rng)
+    X[[3, 17, 40]] = 0
+    X[25,:4] = 0
+    c = client(X, workers=workers)
+    c.uq_compute_local_zeros()
+    assert np.array_equal(c.local_zeros, [3, 17, 40])
+    # Only rows that are zero at every site are left out
+    c.uq_set_global_zeros(np.array([3, 40]))
+    c.uq_compute_uquartile()
+    keep = np.setdiff1d(np.arange(X.shape[0]), [3, 40])
+    assert np.array_equal(c.uquartile, np.quantile(X[keep], 0.75, axis=0))
+
+
+def test_upper_quartile_rejects_nans(capsys):
+    X = np.random.default_rng(12).lognormal(size=(20, 3))
+    X[5,1] = np.nan
+    with pytest.raises(SystemExit):
+        client(X).uq_compute_local_zeros()
+    assert "ERROR" in capsys.readouterr().out
+
+
+def normalize(path, mode, compute_dtype, compute_tolerance=None):
+    c = algo.Client(f"{path}/", f"{path}/")
+    c.read_input("data.csv", ",", compute_dtype=compute_dtype, compute_tolerance=compute_tolerance)
+    if mode == "quantile":
+        c.q_compute_local_means()
+        c.q_set_global_means(c.local_means[1]/c.local_means[0])
+        c.q_compute_local_result()
+    elif mode == "upper quartile":
+        c.uq_compute_local_zeros()
+        c.uq_set_global_zeros(c.local_zeros)
+        c.uq_compute_uquartile()
+        c.uq_set_global_result(3.0)
+        c.uq_compute_local_result()
+    else:
+        c.qu_compute_local_statistics()
+        c.qu_set_global_statistics([c.local_means[1]/c.local_means[0], c.local_zeros])
+        c.q_compute_local_result()
+    return c
+
+
+@pytest.mark.parametrize("mode", ["quantile", "upper quartile", "both"])
+def test_float32_deviation_is_checked(tmp_path, mode):
+    X = 10**6 + counts(np.random.default_rng(13), n=200, m=40)
+    pd.DataFrame(X).to_csv(tmp_path / "data.csv", header=False, index=False)
+    reference = normalize(tmp_path, mode, "float64").result.to_numpy()
+
+    c = normalize(tmp_path, mode, "float32")
+    assert c.result.to_numpy().dtype == np.float32
+    assert 0 < c.deviation["bound"] <= algo.COMPUTE_TOLERANCE
+    assert mode == "upper quartile" or "means_max_abs" in c.deviation
+    np.testing.assert_allclose(c.result.to_numpy(), reference, rtol=c.deviation["bound"]*10)
+
+    # Beyond the tolerance the input is normalized in float64
+    c = normalize(tmp_path, mode, "float32", compute_tolerance=1e-12)
+    assert c.compute_dtype == np.float64
+    assert np.array_equal(c.result.to_numpy(), reference)
+
+
+@pytest.mark.parametrize("compute_dtype", ["float64", "float32"])
+@pytest.mark.parametrize("memory_budget", [None, 0.05])
+@pytest.mark.parametrize("mode", ["quantile", "upper quartile", "both"])
+def test_npy_results_are_streamed(tmp_path, mode, memory_budget, compute_dtype):
+    X = counts(np.random.default_rng(14), n=300, m=12)
+    X[7] = 0
+    pd.DataFrame(X, index=[f"g{i}" for i in range(300)], columns=[f"s{j}" for j in range(12)]).to_csv(tmp_path / "data.csv")
+    written = {}
+    for stream in (False, True):
+        c = algo.Client(f"{tmp_path}/", f"{tmp_path}/")
+        c.read_input("data.csv", ",", sample_genes_in_input=True, memory_budget=memory_budget, compute_dtype=compute_dtype)
+        names = {method: f"{stream}_{method.replace(' ', '_')}.csv" for method in ("quantile", "upper quartile")}
+        if stream:
+            for method, name in names.items():
+                c.stream_results(method, name, "npy")
+        if mode != "upper quartile":
+            if mode == "both":
+                c.qu_compute_local_statistics()
+                c.qu_set_global_statistics([c.local_means[1]/c.local_means[0], c.local_zeros])
+            else:
+                c.q_compute_local_means()
+                c.q_set_global_means(c.local_means[1]/c.local_means[0])
+            c.q_compute_local_result()
+            if stream:
+                # The result is computed straight into the output file
+                assert isinstance(c.result, np.memmap) and c.result.filename == f"{tmp_path}/True_quantile.npy"
+            c.write_results(names["quantile"], True, True, "npy")
+        if mode != "quantile":
+            if mode == "both":
+                c.qu_compute_uquartile()
+            else:
+                c.uq_compute_local_zeros()
+                c.uq_set_global_zeros(c.local_zeros)
+                c.uq_compute_uquartile()
+            c.uq_set_global_result(3.0)
+            c.uq_compute_local_result()
+            c.write_results(names["upper quartile"], True, True, "npy")
+        for method, name in names.items():
+            stem = f"{tmp_path}/{name[:-4]}"
+            if mode in ("both", method):
+                written.setdefault(method, []).append([np.load(f"{stem}.npy"), open(f"{stem}.samples.txt").read(), 
+                                                       open(f"{stem}.genes.txt").read()])
+    for (a, *names_a), (b, *names_b) in written.values():
+        assert a.dtype == b.dtype and np.array_equal(a, b) and names_a == names_b
+    assert sorted(p.name for p in tmp_path.iterdir() if p.suffix == ".npy") == \
+        sorted(f"{stream}_{method.replace(' ', '_')}.npy" for stream in (False, True) for method in written)
+
+
+@pytest.mark.parametrize("memory_budget", [None, 0.05])
+def test_combined_mode_matches_both_methods(tmp_path, memory_budget):
+    X = counts(np.random.default_rng(15), n=300, m=12).astype(np.float64)
+    X[[4, 9]] = 0
+    pd.DataFrame(X).to_csv(tmp_path / "data.csv", header=False, index=False)
+    def run(*steps):
+        c = algo.Client(f"{tmp_path}/", f"{tmp_path}/")
+        c.read_input("data.csv", ",", memory_budget=memory_budget)
+        results = []
+        for step in steps:
+            if step == "write":
+                c.write_results("result.csv")
+                results.append(pd.read_csv(tmp_path / "result.csv", header=None).to_numpy())
+            else:
+                step(c)
+        return c, results
+
+    quantile, [expected_quantile] = run(lambda c: c.q_compute_local_means(),
+                                        lambda c: c.q_set_global_means(c.local_means[1]/c.local_means[0]),
+                                        lambda c: c.q_compute_local_result(), "write")
+    upper_quartile, [expected_upper_quartile] = run(lambda c: c.uq_compute_local_zeros(),
+                                                    lambda c: c.uq_set_global_zeros(c.local_zeros),
+                                                    lambda c: c.uq_compute_uquartile(),
+                                                    lambda c: c.uq_set_global_result(3.0),
+                                                    lambda c: c.uq_compute_local_result(), "write")
+    # The sorted columns are only kept without a memory budget
+    kept = []
+    combined, results = run(lambda c: c.qu_compute_local_statistics(),
+                            lambda c: kept.append(c.sort_values is not None),
+                            lambda c: c.qu_set_global_statistics([c.local_means[1]/c.local_means[0], c.local_zeros]),
+                            lambda c: c.q_compute_local_result(), "write",
+                            lambda c: c.qu_compute_uquartile(),
+                            lambda c: c.uq_set_global_result(3.0),
+                            lambda c: c.uq_compute_local_result(), "write")
+    assert kept == [memory_budget is None]
+    assert np.array_equal(combined.local_means[1], quantile.local_means[1])
+    assert np.array_equal(combined.local_zeros, upper_quartile.local_zeros)
+    assert np.array_equal(combined.uquartile, upper_quartile.uquartile)
+    assert np.array_equal(results[0], expected_quantile)
+    assert np.array_equal(results[1], expected_upper_quartile)
+    assert not any(p.suffix == ".npy" for p in tmp_path.iterdir())
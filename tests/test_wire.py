@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from app import wire
+
+
+def assert_same(decoded, value):
+    if isinstance(value, (list, tuple)):
+        assert isinstance(decoded, list) and len(decoded) == len(value)
+        for d, v in zip(decoded, value):
+            assert_same(d, v)
+        return
+    value = np.asarray(value)
+    decoded = np.asarray(decoded)
+    assert decoded.dtype == value.dtype.newbyteorder("<")
+    assert decoded.shape == value.shape
+    assert np.array_equal(decoded, value, equal_nan=value.dtype.kind == "f")
+
+
+PAYLOADS = {
+    "raw": [np.arange(12, dtype=np.float64).reshape(3, 4), np.array([3, 1, 2], dtype=np.int32)],
+    # A sorted set of row indices is sent as a bitmap
+    "bitmap": [np.arange(3, 3000, 7, dtype=np.intp)],
+    "sparse_indices": [np.array([0, 5, 17, 100000], dtype=np.intp)],
+    # A sorted float64 vector is XOR-delta encoded when compressed
+    "xor_delta": [np.sort(np.random.default_rng(0).normal(size=1000))],
+    "scalars": [np.float64(2.5), 7, True],
+    "nested": [[10, np.linspace(0, 1, 5)], [np.array([], dtype=np.intp), np.array([2, 4], dtype=np.int64)]],
+    "nan": [np.array([1.0, np.nan, 3.0])],
+    "big_endian": [np.arange(5, dtype=">f8")],
+}
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("name", sorted(PAYLOADS))
+def test_round_trip(name, compress):
+    value = PAYLOADS[name]
+    assert_same(wire.decode(wire.encode(value, compress)), value)
+
+
+def test_encodings_are_used():
+    indices = PAYLOADS["bitmap"][0]
+    assert len(wire.encode(indices)) < len(wire.encode(indices.astype(np.float64)))
+    values = PAYLOADS["xor_delta"][0]
+    assert len(wire.encode(values, compress=True)) < len(wire.encode(values))
+
+
+def test_raw_arrays_are_decoded_without_copy():
+    payload = bytearray(wire.encode([np.int8(1), np.arange(3, dtype=np.float64)]))
+    decoded = wire.decode(payload)[1]
+    assert not decoded.flags.owndata
+    assert (decoded.ctypes.data - np.frombuffer(payload, dtype=np.uint8).ctypes.data) % 8 == 0
+
+
+@pytest.mark.parametrize("value", [
+    np.array([1 + 2j], dtype=np.complex128),
+    np.array(["sample1"]),
+    np.array(["2020-01-01"], dtype="M8[ns]"),
+    np.array([object()], dtype=object),
+])
+def test_unsupported_dtypes_are_rejected(value):
+    with pytest.raises(ValueError):
+        wire.encode([value])
+
+
+def test_foreign_payload_is_rejected():
+    with pytest.raises(ValueError):
+        wire.decode(b"not a payload at all")